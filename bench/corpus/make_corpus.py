@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+重新生成解析器基准测试用的 HTML 样本（结果已随仓库保存，一般不需要运行）。
+
+python bench/corpus/make_corpus.py
+"""
+import os
+import random
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+rnd = random.Random(18)
+
+HEAD = ('<!DOCTYPE html><html><head><meta charset="utf-8"><title>{title} - 禁忌书屋</title>'
+        '<link rel="stylesheet" href="/css/forum.css"><script>var tid = 1234567; function show(){{}}</script>'
+        '<style>.quote{{font-size:14px}} div.nav a{{color:#333}}</style></head><body>')
+NAV = ('<div id="top"><div class="logo"><a href="/"><img src="/logo.gif"></a></div>'
+       '<div class="menu"><a href="index.php?app=forum&act=gold">精华区</a> | <a href="#">搜索</a></div></div>')
+FOOT = '<div class="footer">Copyright &copy; cool18.com<br>联系我们</div></body></html>'
+
+
+def paragraphs(n, lo=40, hi=300):
+    words = "他她我们你这那里说道看着心中一片寂静夜色如水灯火阑珊风吹过窗台远处传来钟声"
+    return ["　　" + "".join(rnd.choice(words) for _ in range(rnd.randint(lo, hi))) for _ in range(n)]
+
+
+def chapter(title, n, br="<br>"):
+    return br.join(paragraphs(n)) + "  双空格分段  后文"
+
+
+def ads(k):
+    return "".join(f'<div class="ad" id="ad{i}"><a href="/ad/{i}"><img src="/ad{i}.jpg"></a></div>' for i in range(k))
+
+
+def links(k):
+    return "<div class=\"nav\">" + "".join(
+        f'<a href="index.php?app=forum&act=threadview&tid={2000000 + i}">某书（{i}）</a><br>' for i in range(k)) + "</div>"
+
+
+def save(name, html):
+    with open(os.path.join(HERE, name), "w", encoding="utf-8", newline="") as f:
+        f.write(html)
+    print(f"{name}: {len(html.encode('utf-8')) / 1024:.1f} KB")
+
+
+def main():
+    # 典型章节页：一个 quote 正文，周围有导航、广告、脚本
+    save("chapter_quote.html", HEAD.format(title="某书（12）") + NAV + ads(6) + links(40)
+         + '<div class="quote">' + chapter("某书", 60) + '</div>' + ads(4) + FOOT)
+
+    # 带引用回复的帖子：多个 quote 块，<br> 写法混杂
+    blocks = "".join(f'<div class=\'quote\' id="q{i}"><b>回复 {i}</b><BR/>' + chapter("回复", 8, br="<br />") + "</div>"
+                     for i in range(25))
+    save("multi_quote.html", HEAD.format(title="某书（3）") + NAV + blocks + FOOT)
+
+    # 没有 quote：退回到最长的 div
+    divs = "".join(f'<div class="row r{i}"><span>{i}</span> 楼 <a href="#">引用</a></div>' for i in range(400))
+    save("no_quote_fallback.html", HEAD.format(title="某书（7）") + NAV + divs
+         + '<div class="content">' + chapter("某书", 80) + '</div>' + FOOT)
+
+    # 深层嵌套：几千层 div 只在最里面有正文
+    depth = 3000
+    save("nested_divs.html", HEAD.format(title="某书（9）") + "<div>" * depth + chapter("某书", 30)
+         + "</div>" * depth + FOOT)
+
+    # 大量未闭合的 div：旧的回退正则对每个 <div 都要扫到文末
+    save("unclosed_divs.html", HEAD.format(title="某书（5）") + NAV + '<div class="body">' + chapter("某书", 20)
+         + "</div>" + "".join(f'<div class="x{i}">段{i} ' + "字" * rnd.randint(5, 30) for i in range(4000)) + "</body></html>")
+
+    # 标签汤：<br> 出现在标签内部、大小写混杂、孤立的尖括号
+    soup = []
+    for i in range(3000):
+        soup.append(rnd.choice(["<br>", "<BR>", "<br/>", "<Br />", "<a<br>b>", "<<br>>", "1 < 2", "a > b",
+                                "<span style='x'>", "</span>", "<img src=x>", "字字字", "\n", "<p", "br>"]))
+    save("tag_soup.html", HEAD.format(title="某书（1）") + '<div class="quote">' + "".join(soup) + "</div>" + FOOT)
+
+    # 超长章节
+    save("large_chapter.html", HEAD.format(title="某书（100）") + NAV + links(200)
+         + '<div class="quote">' + chapter("某书", 800) + '</div>' + FOOT)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+本地假 cool18 站点：生成目录页（act=gold）与帖子页（act=threadview），供基准测试使用。
+
+两类书：
+- 内链书：首页 nav 里列出其余章节（新章节在前），章节 tid 之间可能有空洞（404）
+- tid 书：没有内链，章节按 tid 递增，中间穿插别的帖子（前缀不同），末尾跟 3 个无关帖子
+
+可配置延迟、抖动与错误率（随机返回 503）。同一 seed 生成的站点完全相同。
+客户端声明 Accept-Encoding: gzip 时压缩传输（compress=False 关闭），bytes_sent 为线路上的字节数。
+"""
+import gzip
+import random
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+FOREIGN = ["杂谈灌水", "站务公告", "求书帖", "闲聊一下"]
+
+
+class Site:
+    def __init__(self, seed=1, pages=3, books_per_page=4, max_chapters=12, max_foreign=2,
+                 paragraphs=8, latency=0.0, jitter=0.0, error_rate=0.0, compress=True):
+        rnd = random.Random(seed)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.compress = compress
+        self._gzipped = {}      # 页面字节 -> 压缩结果，同一页面只压缩一次
+        self.paragraphs = paragraphs
+        self.threads = {}       # tid -> (标题, 正文, 内链 [(tid, 文字)])
+        self.gold = []          # 每个目录页的 [(首 tid, 书名)]
+        self.books = {}         # 书名 -> (模式, 首 tid, 章节数)
+        self.chapter_tids = set()
+        self._rnd = random.Random(seed + 1)   # 延迟与错误注入
+        self._lock = threading.Lock()
+        self.reset()
+
+        tid = 1000
+        for p in range(pages):
+            items = []
+            for b in range(books_per_page):
+                name = f"书{p}_{b}"
+                n = rnd.randint(1, max_chapters)
+                first = tid
+                if rnd.random() < 0.5:
+                    tid += 1
+                    links = []
+                    for i in range(2, n + 1):
+                        self._put(tid, f"{name}（{i}）", self._body(rnd, name, i))
+                        links.insert(0, (tid, f"{name}（{i}）"))
+                        tid += 1 + rnd.randint(0, 1)
+                    self._put(first, f"{name}（1）", self._body(rnd, name, 1), links)
+                    self.books[name] = ("inner", first, n)
+                else:
+                    self._put(tid, f"{name}（1）", self._body(rnd, name, 1))
+                    tid += 1
+                    for i in range(2, n + 1):
+                        for _ in range(rnd.randint(0, max_foreign)):
+                            self._put(tid, rnd.choice(FOREIGN) + f"({tid})", "foreign", chapter=False)
+                            tid += 1
+                        self._put(tid, f"{name}（{i}）", self._body(rnd, name, i))
+                        tid += 1
+                    for _ in range(3):
+                        self._put(tid, rnd.choice(FOREIGN), "foreign", chapter=False)
+                        tid += 1
+                    self.books[name] = ("tid", first, n)
+                items.append((first, name))
+            self.gold.append(items)
+
+    def _body(self, rnd, name, i):
+        paras = [f"{name}第{i}章 段落{k}" + "字" * rnd.randint(20, 200)
+                 for k in range(rnd.randint(self.paragraphs // 2 or 1, self.paragraphs))]
+        return "　　" + "<br>　　".join(paras) + "  双空格分段  后文"
+
+    def _put(self, tid, title, body, links=(), chapter=True):
+        self.threads[tid] = (title, body, list(links))
+        if chapter:
+            self.chapter_tids.add(tid)
+
+    def reset(self):
+        """清空计数，每轮测试前调用"""
+        with self._lock:
+            self.counts = {}    # tid -> 请求次数
+            self.index_requests = 0
+            self.errors = 0
+            self.bytes_sent = 0     # 线路上的字节（压缩后）
+            self.bytes_body = 0     # 对应的未压缩正文字节
+
+    def waste(self):
+        """多余的帖子页请求：别的帖子 / 不存在的 tid，以及同一页的重复请求"""
+        with self._lock:
+            foreign = sum(c for t, c in self.counts.items() if t not in self.chapter_tids)
+            duplicate = sum(c - 1 for t, c in self.counts.items() if t in self.chapter_tids and c > 1)
+            return {"foreign_or_missing": foreign, "duplicate": duplicate,
+                    "thread_requests": sum(self.counts.values())}
+
+    def gzipped(self, data):
+        with self._lock:
+            gz = self._gzipped.get(data)
+        if gz is None:
+            gz = gzip.compress(data, 6)
+            with self._lock:
+                self._gzipped[data] = gz
+        return gz
+
+    def _delay(self):
+        with self._lock:
+            d = self.latency + (self._rnd.uniform(0, self.jitter) if self.jitter else 0.0)
+            fail = self.error_rate and self._rnd.random() < self.error_rate
+            if fail:
+                self.errors += 1
+        return d, fail
+
+    def page(self, q):
+        act = q.get("act", [""])[0]
+        if act == "gold":
+            with self._lock:
+                self.index_requests += 1
+            p = int(q.get("p", ["1"])[0])
+            if p > len(self.gold):
+                return 200, "<html><body>empty</body></html>"
+            a = "".join(f'<li><a href="index.php?app=forum&act=threadview&tid={t}">{n}</a></li>'
+                        for t, n in self.gold[p - 1])
+            return 200, f"<html><head><title>gold</title></head><body><ul>{a}</ul></body></html>"
+        if act == "threadview":
+            tid = int(q.get("tid", ["0"])[0])
+            with self._lock:
+                self.counts[tid] = self.counts.get(tid, 0) + 1
+            if tid not in self.threads:
+                return 404, "not found"
+            title, body, links = self.threads[tid]
+            nav = "".join(f'<a href="index.php?app=forum&act=threadview&tid={t}">{x}</a>' for t, x in links)
+            return 200, (f"<html><head><title>{title} - 禁忌书屋</title></head><body>"
+                         f"<div class=\"nav\">{nav}</div><div class=\"quote\">{body}</div></body></html>")
+        return 404, "?"
+
+
+def serve(site, host="127.0.0.1", port=0):
+    """在后台线程启动站点，返回 server（server.server_address[1] 为端口）"""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            delay, fail = site._delay()
+            if delay:
+                time.sleep(delay)
+            if fail:
+                code, text = 503, "busy"
+            else:
+                code, text = site.page(parse_qs(urlparse(self.path).query))
+            data = text.encode("utf-8")
+            etag = '"%x"' % (hash(data) & 0xffffffff)
+            if code == 200 and self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+            size = len(data)
+            gz = site.compress and code == 200 and "gzip" in self.headers.get("Accept-Encoding", "")
+            if gz:
+                data = site.gzipped(data)
+            self.send_response(code)
+            if code == 200:
+                self.send_header("ETag", etag)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            if gz:
+                self.send_header("Content-Encoding", "gzip")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            try:
+                self.wfile.write(data)
+                with site._lock:
+                    site.bytes_sent += len(data)
+                    site.bytes_body += size
+            except (BrokenPipeError, ConnectionResetError):
+                # tid 探测读到 </title> 就会断开
+                pass
+
+        def log_message(self, *args):
+            pass
+
+    class Server(ThreadingHTTPServer):
+        daemon_threads = True
+
+        def handle_error(self, request, client_address):
+            pass
+
+    srv = Server((host, port), Handler)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    return srv
+
+
+if __name__ == "__main__":
+    import argparse
+    ap = argparse.ArgumentParser(description="启动本地假 cool18 站点")
+    ap.add_argument("--port", type=int, default=8018)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--pages", type=int, default=3)
+    ap.add_argument("--latency", type=float, default=0.0)
+    ap.add_argument("--jitter", type=float, default=0.0)
+    ap.add_argument("--error-rate", type=float, default=0.0)
+    ap.add_argument("--no-compress", action="store_true", help="不压缩传输")
+    args = ap.parse_args()
+    s = Site(seed=args.seed, pages=args.pages, latency=args.latency,
+             jitter=args.jitter, error_rate=args.error_rate, compress=not args.no_compress)
+    serve(s, port=args.port)
+    print(f"http://127.0.0.1:{args.port}/bbs4/index.php?app=forum&act=gold&p=1  （Ctrl+C 退出）")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+正文提取微基准：用 bench/corpus/ 下保存的页面比较 1.0 版（cool18-spider.py）与
+多线程版（cool18-spider-threaded.py）的 extract_text，先核对输出一致，再报告 MB/s。
+多线程版还要求直接传入 UTF-8 字节时结果相同（抓取层不再整页解码）。
+
+python bench/parser_bench.py
+python bench/parser_bench.py --min-time 1 -o parser.json
+"""
+import argparse
+import contextlib
+import glob
+import importlib.util
+import json
+import os
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(HERE)
+CORPUS = os.path.join(HERE, "corpus")
+
+
+def load(name, script):
+    """在临时目录里加载脚本（两个脚本导入时都会创建 output/ list/）"""
+    cwd = os.getcwd()
+    os.chdir(tempfile.mkdtemp(prefix="cool18-parser-"))
+    try:
+        spec = importlib.util.spec_from_file_location(name, os.path.join(REPO, script))
+        m = importlib.util.module_from_spec(spec)
+        with contextlib.redirect_stdout(sys.stderr):
+            spec.loader.exec_module(m)
+        return m
+    finally:
+        os.chdir(cwd)
+
+
+def measure(fn, html, min_time):
+    """重复调用直到累计超过 min_time 秒，返回单次耗时（取 5 组中最快的一组）"""
+    number = 1
+    while True:
+        t = time.perf_counter()
+        for _ in range(number):
+            fn(html)
+        elapsed = time.perf_counter() - t
+        if elapsed >= min_time / 5:
+            break
+        number *= 2
+    best = elapsed / number
+    for _ in range(4):
+        t = time.perf_counter()
+        for _ in range(number):
+            fn(html)
+        best = min(best, (time.perf_counter() - t) / number)
+    return best
+
+
+def main():
+    ap = argparse.ArgumentParser(description="extract_text 微基准")
+    ap.add_argument("--min-time", type=float, default=0.5, help="每个样本每个实现的大致计时秒数")
+    ap.add_argument("-o", "--output", help="JSON 结果写入文件")
+    args = ap.parse_args()
+
+    old = load("cool18_v1", "cool18-spider.py").extract_text
+    new = load("cool18_v2", "cool18-spider-threaded.py").extract_text
+
+    results, failed = [], False
+    for path in sorted(glob.glob(os.path.join(CORPUS, "*.html"))):
+        with open(path, encoding="utf-8", newline="") as f:
+            html = f.read()
+        name = os.path.basename(path)
+        data = html.encode("utf-8")
+        mb = len(data) / 1e6
+        same = old(html) == new(html) == new(data)
+        failed |= not same
+        t_old = measure(old, html, args.min_time)
+        t_new = measure(new, html, args.min_time)
+        r = {"file": name, "bytes": len(data), "identical": same,
+             "old_mb_s": round(mb / t_old, 2), "new_mb_s": round(mb / t_new, 2),
+             "speedup": round(t_old / t_new, 2)}
+        results.append(r)
+        print(f"{name:24} {r['bytes'] / 1024:8.1f} KB  旧 {r['old_mb_s']:9.2f} MB/s  新 {r['new_mb_s']:9.2f} MB/s"
+              f"  x{r['speedup']:<6} {'一致' if same else '输出不一致！'}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"time": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "results": results}, f,
+                      ensure_ascii=False, indent=2)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+端到端基准测试：在本地假站点上跑各个抓取引擎，输出 JSON。
+
+python bench/run_bench.py                              # 同步版 / 多线程 / 异步 各跑一轮
+python bench/run_bench.py -e threaded --runs 2         # 同一目录连跑两轮（第二轮测缓存与增量）
+python bench/run_bench.py -e my_engine.py:main --latency 0.05 --jitter 0.02 --error-rate 0.01 -o out.json
+python bench/run_bench.py -e threaded --latency 0 --paragraphs 400 --set PARSE_PROCESSES=4   # 覆盖引擎的模块常量
+
+每个引擎在独立子进程和临时目录中运行（冷启动，峰值内存互不干扰）。结果包括：
+耗时、请求数、pages/s、请求延迟 p50/p95/p99、峰值 RSS、线路字节与正文字节、解码耗时、
+tid 探测浪费、输出文件摘要（与第一个引擎比较是否一致）。
+假站点默认 gzip 传输（--no-compress 关闭）；比较改动前后时用 -e 指向旧版本脚本：
+git show HEAD~1:cool18-spider-threaded.py > /tmp/old.py
+python bench/run_bench.py -e /tmp/old.py:update_novels_threaded -e threaded
+同步版的固定 sleep 默认去掉（--keep-sleep 保留）；带 rate_limiter 的引擎按 --rate 限速。
+"""
+import argparse
+import ast
+import contextlib
+import hashlib
+import importlib.util
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+try:
+    import resource
+except ImportError:     # Windows
+    resource = None
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(HERE)
+sys.path.insert(0, HERE)
+import fakesite
+
+ENGINES = {
+    "sync": ("cool18-spider.py", "update_novels"),
+    "threaded": ("cool18-spider-threaded.py", "update_novels_threaded"),
+    "async": ("cool18-spider-threaded.py", "run_async_update"),
+}
+
+
+def resolve_engine(spec):
+    """内置名称，或 path/to/script.py:函数名"""
+    if spec in ENGINES:
+        script, func = ENGINES[spec]
+        return os.path.join(REPO, script), func
+    script, _, func = spec.partition(":")
+    if not func:
+        raise SystemExit(f"引擎格式应为 script.py:函数名：{spec}")
+    return os.path.abspath(script), func
+
+
+def percentile(sorted_values, q):
+    """最近秩百分位"""
+    if not sorted_values:
+        return None
+    k = max(0, min(len(sorted_values) - 1, int(round(q / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[k]
+
+
+def output_digest(workdir):
+    """output/ 下所有 txt 的摘要，用于比较不同引擎的输出是否一致"""
+    out = os.path.join(workdir, "output")
+    h = hashlib.sha1()
+    files = total = 0
+    for name in sorted(os.listdir(out)) if os.path.isdir(out) else []:
+        if not name.endswith(".txt"):
+            continue
+        with open(os.path.join(out, name), "rb") as f:
+            data = f.read()
+        h.update(name.encode("utf-8") + b"\0" + data + b"\0")
+        files += 1
+        total += len(data)
+    return {"files": files, "bytes": total, "sha1": h.hexdigest()}
+
+
+# ---------- 子进程：加载引擎并计时 ----------
+def instrument(latencies):
+    """给 requests 与 aiohttp 的请求加计时（只算网络往返，不含限速等待）"""
+    try:
+        from requests.adapters import HTTPAdapter
+        send = HTTPAdapter.send
+
+        def timed_send(self, *args, **kwargs):
+            t = time.perf_counter()
+            try:
+                return send(self, *args, **kwargs)
+            finally:
+                latencies.append(time.perf_counter() - t)
+        HTTPAdapter.send = timed_send
+    except ImportError:
+        pass
+    try:
+        import aiohttp
+        request = aiohttp.ClientSession._request
+
+        async def timed_request(self, *args, **kwargs):
+            t = time.perf_counter()
+            try:
+                return await request(self, *args, **kwargs)
+            finally:
+                latencies.append(time.perf_counter() - t)
+        aiohttp.ClientSession._request = timed_request
+    except ImportError:
+        pass
+
+
+def instrument_decode(decode_times):
+    """requests 的 Response.text 整页解码计时（同步版走这条路）"""
+    try:
+        from requests.models import Response
+    except ImportError:
+        return
+    text = Response.text.fget
+
+    def timed_text(self):
+        t = time.perf_counter()
+        try:
+            return text(self)
+        finally:
+            decode_times.append(time.perf_counter() - t)
+    Response.text = property(timed_text)
+
+
+def engine_decode_seconds(m):
+    """引擎自带指标时取其中的解码耗时（stage_seconds{stage="decode"}）"""
+    metrics = getattr(m, "metrics", None)
+    if metrics is None:
+        return 0.0
+    h = metrics.snapshot()["histograms"].get('stage_seconds{stage="decode"}')
+    return h["sum_s"] if h else 0.0
+
+
+def load_engine(script, overrides):
+    """逐条执行引擎模块的顶层语句，每条之后把已定义的被覆盖常量改成覆盖值。
+
+    导入时用常量构造的对象（磁盘缓存、状态库、限速器等）和由常量推导的常量因此也按覆盖值创建，
+    不会在导入之后才改常量、实际测的却是默认配置。引擎里没有的常量报错退出。
+    """
+    spec = importlib.util.spec_from_file_location("engine", script)
+    m = importlib.util.module_from_spec(spec)
+    sys.modules["engine"] = m   # 进程池需要按模块名找到引擎里的函数
+    with open(script, encoding="utf-8") as f:
+        tree = ast.parse(f.read(), script)
+    for node in tree.body:
+        exec(compile(ast.Module([node], type_ignores=[]), script, "exec"), m.__dict__)
+        for name, value in overrides.items():
+            if name in m.__dict__:
+                m.__dict__[name] = value
+    return m
+
+
+def child(args):
+    script, func = resolve_engine(args.engine)
+    os.chdir(args.workdir)
+    latencies, decode_times = [], []
+    instrument(latencies)
+    instrument_decode(decode_times)
+    base = f"http://127.0.0.1:{args.port}/bbs4/index.php?app=forum&act="
+    overrides = {"BASE_URL": base + "threadview&tid=", "INDEX_BASE": base + "gold&p={}"}
+    if args.workers:
+        overrides["MAX_WORKERS"] = args.workers
+    settings = dict(parse_settings(args.set))
+    overrides.update(settings)
+    with open(os.devnull, "w", encoding="utf-8") as devnull, contextlib.redirect_stdout(devnull):
+        m = load_engine(script, overrides)
+        unknown = [name for name in settings if not hasattr(m, name)]
+        if unknown:
+            raise SystemExit(f"--set：引擎 {os.path.basename(script)} 没有这些常量：{', '.join(unknown)}")
+        if hasattr(m, "rate_limiter"):
+            m.rate_limiter.configure(args.rate, max(1, int(args.rate)))
+        elif not args.keep_sleep:
+            m.time = types.SimpleNamespace(**{k: getattr(time, k) for k in dir(time) if not k.startswith("_")})
+            m.time.sleep = lambda s: None
+        t = time.perf_counter()
+        getattr(m, func)()
+        wall = time.perf_counter() - t
+    latencies.sort()
+    rss = None
+    if resource is not None:
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform != "darwin":
+            rss *= 1024
+    result = {
+        "wall_s": round(wall, 4),
+        "client_requests": len(latencies),
+        "latency_ms": {f"p{q}": round(percentile(latencies, q) * 1000, 3) if latencies else None
+                       for q in (50, 95, 99)},
+        "peak_rss_bytes": rss,
+        "decode_s": round(sum(decode_times) + engine_decode_seconds(m), 4),
+    }
+    sys.__stdout__.write(json.dumps(result) + "\n")
+
+
+def parse_settings(settings):
+    """NAME=VALUE 列表；VALUE 按 JSON 解析（数字、true/false），失败则当作字符串"""
+    for item in settings or ():
+        name, _, value = item.partition("=")
+        try:
+            value = json.loads(value)
+        except ValueError:
+            pass
+        yield name.strip(), value
+
+
+# ---------- 主进程：起站点，逐个引擎运行 ----------
+def run_engine(args, site, port, engine, workdir, run):
+    site.reset()
+    cmd = [sys.executable, os.path.abspath(__file__), "--child", "-e", engine,
+           "--port", str(port), "--workdir", workdir, "--rate", str(args.rate)]
+    if args.workers:
+        cmd += ["--workers", str(args.workers)]
+    if args.keep_sleep:
+        cmd.append("--keep-sleep")
+    for item in args.set or ():
+        cmd += ["--set", item]
+    p = subprocess.run(cmd, capture_output=True, text=True, encoding="utf-8")
+    if p.returncode != 0:
+        sys.stderr.write(p.stderr)
+        raise SystemExit(f"引擎 {engine} 运行失败")
+    result = json.loads(p.stdout.strip().splitlines()[-1])
+    waste = site.waste()
+    served = waste["thread_requests"] + site.index_requests
+    result.update({
+        "engine": engine,
+        "run": run,
+        "server_requests": served,
+        "index_requests": site.index_requests,
+        "errors_injected": site.errors,
+        "bytes_sent": site.bytes_sent,
+        "bytes_body": site.bytes_body,
+        "pages_per_s": round(served / result["wall_s"], 2) if result["wall_s"] else None,
+        "waste": waste,
+        "output": output_digest(workdir),
+    })
+    return result
+
+
+def main():
+    ap = argparse.ArgumentParser(description="cool18-spider 端到端基准测试")
+    ap.add_argument("-e", "--engine", action="append",
+                    help="sync / threaded / async 或 script.py:函数名，可重复；默认三个内置引擎")
+    ap.add_argument("--runs", type=int, default=1, help="每个引擎在同一目录连跑的轮数")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--pages", type=int, default=3, help="目录页数")
+    ap.add_argument("--books-per-page", type=int, default=8)
+    ap.add_argument("--max-chapters", type=int, default=20)
+    ap.add_argument("--paragraphs", type=int, default=8, help="每章最多段落数（控制页面大小与解析开销）")
+    ap.add_argument("--latency", type=float, default=0.02, help="服务端固定延迟（秒）")
+    ap.add_argument("--jitter", type=float, default=0.0, help="在固定延迟上追加 0~jitter 秒随机延迟")
+    ap.add_argument("--error-rate", type=float, default=0.0, help="随机返回 503 的比例")
+    ap.add_argument("--no-compress", action="store_true", help="假站点不压缩传输")
+    ap.add_argument("--rate", type=float, default=1000.0, help="带限速器的引擎每主机每秒请求数")
+    ap.add_argument("--workers", type=int, default=0, help="覆盖引擎的 MAX_WORKERS（引擎没有时忽略）")
+    ap.add_argument("--keep-sleep", action="store_true", help="保留同步版的固定 sleep")
+    ap.add_argument("--set", action="append", metavar="NAME=VALUE",
+                    help="覆盖引擎模块的常量（在导入过程中生效，导入时创建的对象也按覆盖值构造），可重复")
+    ap.add_argument("--keep", action="store_true", help="保留各引擎的临时工作目录")
+    ap.add_argument("-o", "--output", help="JSON 结果写入文件（默认打印）")
+    # 子进程内部参数
+    ap.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    ap.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    ap.add_argument("--workdir", help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.child:
+        args.engine = args.engine[0]
+        return child(args)
+
+    engines = args.engine or ["sync", "threaded", "async"]
+    site = fakesite.Site(seed=args.seed, pages=args.pages, books_per_page=args.books_per_page,
+                         max_chapters=args.max_chapters, paragraphs=args.paragraphs, latency=args.latency,
+                         jitter=args.jitter, error_rate=args.error_rate, compress=not args.no_compress)
+    srv = fakesite.serve(site)
+    port = srv.server_address[1]
+    results, reference = [], None
+    try:
+        for engine in engines:
+            workdir = tempfile.mkdtemp(prefix="cool18-bench-")
+            try:
+                for run in range(1, args.runs + 1):
+                    r = run_engine(args, site, port, engine, workdir, run)
+                    if run == 1:
+                        reference = reference or r["output"]["sha1"]
+                        r["output"]["same_as_first"] = r["output"]["sha1"] == reference
+                    results.append(r)
+                    print(f"[bench] {engine} 第{run}轮：{r['wall_s']}s，{r['server_requests']} 次请求，"
+                          f"{r['pages_per_s']} pages/s，线路 {r['bytes_sent'] / 1024:.0f} KB，"
+                          f"解码 {r['decode_s'] * 1000:.1f} ms", file=sys.stderr)
+            finally:
+                if args.keep:
+                    print(f"[bench] {engine} 工作目录：{workdir}", file=sys.stderr)
+                else:
+                    shutil.rmtree(workdir, ignore_errors=True)
+    finally:
+        srv.shutdown()
+
+    report = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "commit": git_commit(),
+            "site": {"seed": args.seed, "pages": args.pages, "books_per_page": args.books_per_page,
+                     "max_chapters": args.max_chapters, "paragraphs": args.paragraphs,
+                     "chapters": len(site.chapter_tids),
+                     "latency": args.latency, "jitter": args.jitter, "error_rate": args.error_rate,
+                     "compress": not args.no_compress},
+            "rate": args.rate,
+            "workers": args.workers or None,
+            "settings": dict(parse_settings(args.set)),
+        },
+        "results": results,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "-C", REPO, "rev-parse", "--short", "HEAD"],
+                              capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+if __name__ == "__main__":
+    main()
@@ -6,325 +6,3872 @@ cool18 禁忌书屋「多线程优化版本」
 """
 import os
 import re
+import argparse
 import time
+import json
 import random
+import zlib
+import zipfile
+import shutil
+import io
+import codecs
+import hashlib
+import sqlite3
+import queue
 import requests
+import urllib3
 import subprocess
+import multiprocessing
+import socket
 import sys
-from urllib.parse import urljoin
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from threading import Lock
+from urllib.parse import urljoin, urlsplit
+from email.utils import parsedate_to_datetime
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from collections import deque, namedtuple
+from contextlib import contextmanager
+from threading import Lock, Condition, Event, Semaphore, Thread, local, get_ident
+import asyncio
+import mmap
+from bisect import bisect_left
+from xml.sax.saxutils import escape as xml_escape, unescape as xml_unescape
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+try:
+    import aiohttp  # 可选依赖：仅异步模式需要
+except ImportError:
+    aiohttp = None
+
+try:
+    import brotli  # 可选依赖：装了才声明支持 br 压缩（urllib3 与 aiohttp 都用它解压）
+except ImportError:
+    try:
+        import brotlicffi as brotli
+    except ImportError:
+        brotli = None
+
+try:
+    import zstandard  # 可选依赖：装了打包归档默认用 zstd，否则用 gzip
+except ImportError:
+    zstandard = None
+
+try:
+    import fcntl  # 打包归档的跨进程文件锁（Windows 用 msvcrt）
+except ImportError:
+    fcntl = None
+    import msvcrt
 
 if sys.platform == "win32":
     subprocess.run("chcp 65001", shell=True, capture_output=True)
 
-BASE_URL = "https://www.cool18.com/bbs4/index.php?app=forum&act=threadview&tid="
-INDEX_BASE = "https://www.cool18.com/bbs4/index.php?app=forum&act=gold&p={}"
-HEADERS = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"}
-TIMEOUT = 15
-RETRY = 3
+BASE_URL = "https://www.cool18.com/bbs4/index.php?app=forum&act=threadview&tid="
+INDEX_BASE = "https://www.cool18.com/bbs4/index.php?app=forum&act=gold&p={}"
+# 两个引擎声明同样的压缩方式；正文流式解压后以字节交给解析，不整页解码
+ACCEPT_ENCODING = "gzip, deflate, br" if brotli is not None else "gzip, deflate"
+HEADERS = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
+           "Accept-Encoding": ACCEPT_ENCODING}
+TIMEOUT = 15
+RETRY = 3                   # 每个 URL 最多尝试次数（含第一次）
+
+# 重试与熔断
+BACKOFF_BASE = 0.5          # 指数退避基数（秒），第 n 次重试前随机等待 0 ~ BASE*2^n
+BACKOFF_MAX = 30.0          # 单次退避上限
+RETRY_BUDGET = 0.1          # 重试预算：重试次数不超过请求数的 10%
+RETRY_BUDGET_MIN = 10       # 预算余额上限，也是起步时可用的重试次数
+BREAKER_WINDOW = 50         # 熔断器统计最近多少次请求
+BREAKER_MIN_SAMPLES = 20    # 样本不足时不熔断
+BREAKER_THRESHOLD = 0.5     # 失败率达到该值即熔断
+BREAKER_COOLDOWN = 30.0     # 熔断后暂停秒数，连续熔断时翻倍
+BREAKER_COOLDOWN_MAX = 600.0
+
+# 配置常量
+MAX_PAGES = 38
+RATE = 8.0       # 每个主机每秒请求数（令牌桶速率）
+BURST = 8        # 令牌桶容量（允许的突发请求数）
+MAX_WORKERS = 8  # 初始在途请求数；关闭自动调速时即固定并发数
+AUTO_TUNE = True        # 按请求延迟与错误率自动调整在途请求数（AIMD）
+MIN_CONCURRENCY = 2     # 自动调速的下限
+MAX_CONCURRENCY = 32    # 自动调速的上限（抓取线程数按此创建）
+LATENCY_TOLERANCE = 1.5 # 延迟中位数超过基线的倍数，视为服务器开始排队
+REORDER_WINDOW = 64  # 写出器最多缓存的乱序章节数
+PROBE_WINDOW_MIN = 2    # tid 探测的投机窗口下限
+PROBE_WINDOW_MAX = 16   # tid 探测的投机窗口上限
+PROBE_CHUNK = 2048      # tid 探测时流式读取的块大小
+BOOK_QUEUE_SIZE = 32    # 目录页预取后待下载书目的队列上限
+SCHEDULER_POLICY = "shortest"  # 章节调度策略：shortest（剩余章节最少的书优先）/ fifo（先开始的书优先）
+MAX_OPEN_BOOKS = 32     # 同时处于下载中的书（各自占一个写出器）上限
+PARSE_PROCESSES = 0     # >0 时正文提取与清洗交给这么多个子进程，抓取线程只做网络 I/O
+PARSE_BATCH = 8         # 每次发给子进程的页面数上限（积压时合并发送，摊薄进程间通信）
+PARSE_TIMEOUT = 60      # 等子进程结果的秒数（含首次启动子进程），超时就在当前线程解析
+CHECKPOINT = True       # 新书每写出一章保存断点，中断后从断点续抓
+MISSING_REBUILDS = 3    # 内链章节一直下载失败时，最多因此整本重抓的次数
+DEDUP = "off"           # 章节去重范围：off（默认，输出与 1.0 版一致）/ book（同一本书内）/ library（全库，转载成另一本书的章节也跳过）
+DEDUP_DISTANCE = 3      # SimHash 汉明距离不超过该值视为近似重复
+DEDUP_MIN_CHARS = 200   # 正文短于该字数只做精确比较（短文本的 SimHash 容易误判）
+
+# 分布式抓取（多个节点共享任务队列）
+QUEUE_BACKEND = "sqlite"    # 任务队列后端，见 WORK_QUEUE_BACKENDS
+LEASE_TTL = 60.0            # 任务租约秒数，节点每 1/3 租期续租一次；过期未续的任务重新排队
+QUEUE_POLL = 1.0            # 队列暂时没有任务时的轮询间隔
+QUEUE_MAX_ATTEMPTS = 3      # 同一任务最多领取次数（失败或租约过期都算一次）
+CLUSTER_RATE = 8.0          # 所有节点合计每秒请求数，按在线节点数平分（每个节点不超过 RATE）
+CLUSTER_OPEN_BOOKS = 4      # 每个节点同时持有的书任务上限，留给其他节点领取
+
+# 监视模式
+WATCH_INTERVAL = 300.0      # 轮询目录页的间隔秒数
+WATCH_PAGES = 1             # 每次轮询前几个目录页
+
+# 磁盘缓存
+CACHE_ENABLED = True
+CACHE_DIR = "cache"
+CACHE_MAX_BYTES = 512 * 1024 * 1024   # 超过后按最近使用时间淘汰
+CACHE_MAX_AGE = 30 * 86400            # 超过该时间未使用的条目直接淘汰
+CACHE_FRESH_INDEX = 0                 # 目录页每次都重新验证
+CACHE_FRESH_THREAD = 86400            # 帖子页一天内直接用本地缓存
+
+# 运行指标
+METRICS_ENABLED = True
+METRICS_INTERVAL = 30    # 每隔多少秒把指标快照写入 METRICS_FILE，0 表示只在每轮结束时写
+METRICS_PORT = 0         # >0 时在 127.0.0.1 的该端口提供 Prometheus 文本格式的 /metrics
+
+OUTPUT_DIR = "output"
+LIST_DIR = "list"
+OUTPUT_BACKEND = "txt"      # txt：每本书一个 output/书名.txt；pack：所有书压缩打包进 output/library.pack
+PACK_CODEC = "zstd" if zstandard is not None else "gzip"
+PACK_LEVEL = 9              # 压缩级别（zstd 1-22，gzip 1-9）
+EPUB_OUTPUT = False         # True 时另外生成 output/书名.epub，章节边抓边打包
+EPUB_LEVEL = 6              # EPUB 内 XHTML 的 deflate 级别
+EPUB_TITLE_CHARS = 30       # 章节首行不超过这么多字时用作目录标题
+os.makedirs(OUTPUT_DIR, exist_ok=True)
+os.makedirs(LIST_DIR, exist_ok=True)
+
+TID_INDEX_ENABLED = True
+TID_INDEX_DB = os.path.join(LIST_DIR, "tid_index.db")
+
+MAIN_LIST = os.path.join(LIST_DIR, "main.list")
+TEMP_LIST = os.path.join(LIST_DIR, "temp.list")
+STATE_DB = os.path.join(LIST_DIR, "state.db")   # 书目状态库，取代 main.list / temp.list
+MANIFEST_DIR = os.path.join(LIST_DIR, "manifest")
+METRICS_FILE = os.path.join(LIST_DIR, "metrics.json")
+PACK_FILE = os.path.join(OUTPUT_DIR, "library.pack")    # 打包归档：压缩块依次追加
+PACK_INDEX = os.path.join(OUTPUT_DIR, "library.idx")    # 每块一行：书名、首 tid、偏移、长度
+DEDUP_DB = os.path.join(LIST_DIR, "dedup.db")   # 章节指纹库
+QUEUE_DB = os.path.join(LIST_DIR, "queue.db")   # 分布式任务队列，多台机器时指向共享目录
+WATCH_FILE = os.path.join(LIST_DIR, "watch.json")   # 监视模式上次看到的目录页快照
+os.makedirs(MANIFEST_DIR, exist_ok=True)
+
+# 线程锁
+file_lock = Lock()
+print_lock = Lock()
+
+
+# ---------- 运行指标（计数器 + 延迟直方图） ----------
+# 直方图分桶上界（秒），覆盖从解析一页到一次超时
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def label_value(v):
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def series_name(key):
+    """(名称, 标签) -> name{k="v",...}"""
+    name, labels = key
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{k}="{label_value(v)}"' for k, v in labels) + "}"
+
+
+class Metrics:
+    """进程内指标：计数器与固定分桶的直方图。
+
+    每次记录只是一次加锁的字典更新（直方图再加一次二分查找），可以常开。
+    标签作为关键字参数传入，如 metrics.inc("http_requests_total", kind="thread", status=200)。
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS, enabled=True):
+        self.buckets = buckets
+        self.enabled = enabled
+        self.started = time.time()
+        self._counters = {}
+        self._hists = {}    # key -> [各桶计数（最后一个是 +Inf）, 总和, 次数]
+        self._lock = Lock()
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        i = bisect_left(self.buckets, seconds)
+        with self._lock:
+            h = self._hists.get(key)
+            if h is None:
+                h = self._hists[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            h[0][i] += 1
+            h[1] += seconds
+            h[2] += 1
+
+    def timer(self, name, **labels):
+        """with metrics.timer("stage_seconds", stage="extract"): ... 记录块内耗时"""
+        return _Timer(self, name, labels)
+
+    def _copy(self):
+        with self._lock:
+            return dict(self._counters), {k: (list(h[0]), h[1], h[2]) for k, h in self._hists.items()}
+
+    def quantile(self, counts, total, q):
+        """按分桶估计分位数：返回第 q 分位所在桶的上界（落在 +Inf 桶时取最大上界）"""
+        rank = q * total
+        seen = 0
+        for bound, c in zip(self.buckets, counts):
+            seen += c
+            if seen >= rank:
+                return bound
+        return self.buckets[-1]
+
+    def snapshot(self):
+        counters, hists = self._copy()
+        return {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "uptime_s": round(time.time() - self.started, 1),
+            "counters": {series_name(k): v for k, v in sorted(counters.items())},
+            "histograms": {
+                series_name(k): {"count": n, "sum_s": round(total, 6),
+                                 "p50_s": self.quantile(counts, n, 0.5),
+                                 "p95_s": self.quantile(counts, n, 0.95),
+                                 "p99_s": self.quantile(counts, n, 0.99)}
+                for k, (counts, total, n) in sorted(hists.items())},
+        }
+
+    def prometheus(self, prefix="cool18_"):
+        """Prometheus 文本格式（0.0.4）"""
+        counters, hists = self._copy()
+        lines, typed = [], set()
+        for (name, labels), v in sorted(counters.items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {prefix}{name} counter")
+            lines.append(f"{series_name((prefix + name, labels))} {v}")
+        for (name, labels), (counts, total, n) in sorted(hists.items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {prefix}{name} histogram")
+            cumulative = 0
+            for bound, c in zip(self.buckets + (float("inf"),), counts):
+                cumulative += c
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{series_name((prefix + name + '_bucket', labels + (('le', le),)))} {cumulative}")
+            lines.append(f"{series_name((prefix + name + '_sum', labels))} {total}")
+            lines.append(f"{series_name((prefix + name + '_count', labels))} {n}")
+        return "\n".join(lines) + "\n"
+
+    def total(self, name, **match):
+        """某个计数器在所有（或匹配 match 的）标签组合上的和"""
+        counters, _ = self._copy()
+        return sum(v for (n, labels), v in counters.items()
+                   if n == name and all(dict(labels).get(k) == m for k, m in match.items()))
+
+
+class _Timer:
+    __slots__ = ("metrics", "name", "labels", "start")
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, **self.labels)
+
+
+metrics = Metrics(enabled=METRICS_ENABLED)
+
+
+def write_metrics_snapshot(path=None):
+    """把当前指标原子写入 JSON 文件"""
+    path = path or METRICS_FILE
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(metrics.snapshot(), f, ensure_ascii=False, indent=1)
+        os.replace(tmp, path)
+    except OSError as e:
+        with print_lock:
+            print(f"[metrics] 快照写入失败: {e}")
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """/metrics 返回 Prometheus 文本，/metrics.json 返回与快照文件相同的 JSON"""
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            body, ctype = metrics.prometheus().encode("utf-8"), "text/plain; version=0.0.4; charset=utf-8"
+        elif self.path == "/metrics.json":
+            body, ctype = json.dumps(metrics.snapshot(), ensure_ascii=False).encode("utf-8"), "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+_metrics_started = False
+_metrics_lock = Lock()
+
+
+def start_metrics():
+    """启动定时快照线程，METRICS_PORT > 0 时再启动本机 HTTP 端点；重复调用无副作用"""
+    global _metrics_started
+    with _metrics_lock:
+        if _metrics_started or not metrics.enabled:
+            return
+        _metrics_started = True
+    if METRICS_INTERVAL > 0:
+        def loop():
+            while True:
+                time.sleep(METRICS_INTERVAL)
+                write_metrics_snapshot()
+        Thread(target=loop, name="metrics-snapshot", daemon=True).start()
+    if METRICS_PORT > 0:
+        try:
+            server = ThreadingHTTPServer(("127.0.0.1", METRICS_PORT), MetricsHandler)
+        except OSError as e:
+            print(f"[metrics] 无法监听 127.0.0.1:{METRICS_PORT}: {e}")
+            return
+        server.daemon_threads = True
+        Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+        print(f"[metrics] Prometheus 指标：http://127.0.0.1:{METRICS_PORT}/metrics")
+
+
+def report_metrics():
+    """每轮结束：写快照并打印一行摘要"""
+    if not metrics.enabled:
+        return
+    write_metrics_snapshot()
+    print(f"[metrics] 请求 {metrics.total('http_requests_total')} 次，"
+          f"重试 {metrics.total('http_retries_total')} 次，"
+          f"下载 {metrics.total('http_bytes_total') / 1e6:.1f} MB，"
+          f"写出 {metrics.total('book_chapters_total')} 章；详见 {METRICS_FILE}")
+
+
+# ---------- 优化的网络请求 ----------
+# 创建一个全局session，复用连接
+session = requests.Session()
+session.headers.update(HEADERS)
+
+
+class TimedHTTPConnection(urllib3.connection.HTTPConnection):
+    """新建连接时记录建连耗时（DNS + TCP，HTTPS 还包括 TLS 握手）"""
+
+    def connect(self):
+        with metrics.timer("http_connect_seconds"):
+            super().connect()
+
+
+class TimedHTTPSConnection(urllib3.connection.HTTPSConnection):
+    def connect(self):
+        with metrics.timer("http_connect_seconds"):
+            super().connect()
+
+
+class TimedHTTPConnectionPool(urllib3.connectionpool.HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(urllib3.connectionpool.HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimedAdapter(requests.adapters.HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": TimedHTTPConnectionPool,
+                                                   "https": TimedHTTPSConnectionPool}
+
+
+def mount_adapter():
+    """按当前并发上限挂载连接池（每主机的连接数不少于在途请求数），换下来的旧连接池随即关闭。
+    重试统一由 fetch_body 的重试策略处理，连接层不再自行重试"""
+    old = session.adapters.get('https://')
+    adapter = TimedAdapter(
+        pool_connections=20,
+        pool_maxsize=max(20, MAX_CONCURRENCY if AUTO_TUNE else MAX_WORKERS),
+        max_retries=0
+    )
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    if old is not None:
+        old.close()
+
+
+mount_adapter()
+
+
+# ---------- 限速（按主机的令牌桶） ----------
+class TokenBucket:
+    """单个主机的令牌桶：匀速补充令牌，遇 429/503 减半速率并按 Retry-After 暂停"""
+
+    def __init__(self, rate, burst):
+        self.base_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.paused_until = 0.0
+
+    def reserve(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= 1
+        wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        return max(wait, self.paused_until - now)
+
+
+class RateLimiter:
+    """进程内共享的限速器，所有线程 / 协程在发请求前先取令牌"""
+    MIN_RATE = 0.2
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}
+        self._lock = Lock()
+
+    def configure(self, rate, burst):
+        with self._lock:
+            self.rate, self.burst = rate, burst
+            self._buckets.clear()
+
+    def rebase(self, rate, burst):
+        """改变配置速率但保留各主机的限流状态（分布式时在线节点数变化，重新分摊全站预算）"""
+        with self._lock:
+            self.rate, self.burst = rate, burst
+            for b in self._buckets.values():
+                b.base_rate, b.burst = rate, burst
+                b.rate = min(b.rate, rate)
+                b.tokens = min(b.tokens, burst)
+
+    def _bucket(self, url):
+        host = urlsplit(url).netloc
+        b = self._buckets.get(host)
+        if b is None:
+            b = self._buckets[host] = TokenBucket(self.rate, self.burst)
+        return b
+
+    def reserve(self, url):
+        """预约一个令牌，返回需要等待的秒数"""
+        with self._lock:
+            return self._bucket(url).reserve(time.monotonic())
+
+    def acquire(self, url):
+        wait = self.reserve(url)
+        if wait > 0:
+            time.sleep(wait)
+
+    def throttled(self, url, retry_after=None):
+        """服务器返回 429/503：速率减半，并在 Retry-After 期间停止发放令牌"""
+        with self._lock:
+            b = self._bucket(url)
+            b.rate = max(self.MIN_RATE, b.rate / 2)
+            pause = retry_after if retry_after is not None else 1 / b.rate
+            b.paused_until = max(b.paused_until, time.monotonic() + pause)
+            b.tokens = min(b.tokens, 0)
+        with print_lock:
+            print(f"[limit] {urlsplit(url).netloc} 被限流，速率降至 {b.rate:.2f}/s，暂停 {pause:.1f}s")
+
+    def succeeded(self, url):
+        """请求成功：线性恢复到配置速率"""
+        with self._lock:
+            b = self._bucket(url)
+            if b.rate < b.base_rate:
+                b.rate = min(b.base_rate, b.rate + b.base_rate / 20)
+
+
+def parse_retry_after(value):
+    """解析 Retry-After（秒数或 HTTP 日期），无法解析时返回 None"""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+rate_limiter = RateLimiter(RATE, BURST)
+
+
+# ---------- 重试策略（分类 + 指数退避 + 预算 + 熔断） ----------
+PERMANENT_ERRORS = (requests.exceptions.InvalidURL, requests.exceptions.MissingSchema,
+                    requests.exceptions.InvalidSchema, requests.exceptions.TooManyRedirects)
+if aiohttp is not None:
+    PERMANENT_ERRORS += (aiohttp.InvalidURL, aiohttp.TooManyRedirects)
+
+
+def is_retryable(code, error=None):
+    """超时、连接错误、5xx、408、429 可以重试；其余 4xx 与 URL 错误重试也不会变"""
+    if code is not None:
+        return code >= 500 or code in (408, 429)
+    return not isinstance(error, PERMANENT_ERRORS)
+
+
+def backoff(attempt):
+    """第 attempt 次失败后的等待时间：指数增长、全随机抖动，避免所有线程同时重试"""
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+class RetryBudget:
+    """每个新请求存入 ratio 个令牌，每次重试取走一个，余额不超过 cap：重试量长期不超过请求量的 ratio"""
+
+    def __init__(self, ratio, cap):
+        self.ratio = ratio
+        self.cap = cap
+        self.balance = cap
+        self._lock = Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.balance = min(self.cap, self.balance + self.ratio)
+
+    def withdraw(self):
+        with self._lock:
+            if self.balance < 1:
+                return False
+            self.balance -= 1
+            return True
+
+
+class CircuitBreaker:
+    """统计最近的请求结果，失败率过高时让所有线程 / 协程暂停一段时间。
+
+    冷却结束后放行请求，下一个结果决定恢复（成功）还是再次熔断（失败，冷却时间翻倍）。
+    """
+
+    def __init__(self, window, min_samples, threshold, cooldown, cooldown_max):
+        self.min_samples = min_samples
+        self.threshold = threshold
+        self.base_cooldown = cooldown
+        self.cooldown_max = cooldown_max
+        self.cooldown = cooldown
+        self.open_until = 0.0
+        self.half_open = False
+        self._results = deque(maxlen=window)
+        self._lock = Lock()
+
+    def delay(self):
+        """熔断中还需等待的秒数"""
+        with self._lock:
+            return max(0.0, self.open_until - time.monotonic())
+
+    def wait(self):
+        while True:
+            d = self.delay()
+            if d <= 0:
+                return
+            time.sleep(d)
+
+    def record(self, ok):
+        with self._lock:
+            if self.half_open:
+                self.half_open = False
+                if ok:
+                    self.cooldown = self.base_cooldown
+                    return
+                self._trip(1.0, self.cooldown * 2)
+                return
+            self._results.append(ok)
+            if len(self._results) < self.min_samples:
+                return
+            failure = self._results.count(False) / len(self._results)
+            if failure >= self.threshold:
+                self._trip(failure, self.cooldown)
+
+    def _trip(self, failure, cooldown):
+        self.cooldown = min(self.cooldown_max, cooldown)
+        self.open_until = time.monotonic() + self.cooldown
+        self.half_open = True
+        self._results.clear()
+        with print_lock:
+            print(f"[breaker] 最近请求失败率 {failure:.0%}，全部暂停 {self.cooldown:.0f}s")
+
+
+# ---------- 自适应并发（AIMD） ----------
+def outcome_ok(error):
+    """请求结果是否说明服务器状态良好；被取消等非请求异常返回 None（不计入统计）"""
+    if error is None:
+        return True
+    if not isinstance(error, Exception):
+        return None
+    code = getattr(getattr(error, "response", None), "status_code", None) or getattr(error, "status", None)
+    return not is_retryable(code, error)
+
+
+class AdaptiveConcurrency:
+    """在途请求数上限，像 TCP 拥塞控制一样每个窗口（约两倍上限个请求）调整一次：
+
+    - 窗口内出现超时 / 5xx / 429：上限乘 0.7
+    - 延迟中位数超过基线 LATENCY_TOLERANCE 倍（服务器在排队）：上限按 容忍倍数×基线/中位数 缩小
+    - 否则若窗口内在途请求确实顶到了上限：上限加 1
+    基线取各窗口延迟中位数的最小值，每个窗口允许上浮 1%，以适应服务器一天中的快慢变化。
+    """
+
+    def __init__(self, initial, low, high, enabled=True):
+        self._cond = Condition()
+        self.inflight = 0
+        self.configure(initial, low, high, enabled)
+
+    def configure(self, initial, low, high, enabled=True):
+        with self._cond:
+            self.low, self.high, self.enabled = low, high, enabled
+            self.limit = float(initial if not enabled else min(high, max(low, initial)))
+            self.baseline = None
+            self._reset_window()
+            self._cond.notify_all()
+
+    def _reset_window(self):
+        self._latencies = []
+        self._errors = 0
+        self._peak = self.inflight
+
+    def try_acquire(self):
+        with self._cond:
+            if self.inflight >= int(self.limit):
+                return False
+            self.inflight += 1
+            self._peak = max(self._peak, self.inflight)
+            return True
+
+    def acquire(self):
+        with self._cond:
+            while self.inflight >= int(self.limit):
+                self._cond.wait()
+            self.inflight += 1
+            self._peak = max(self._peak, self.inflight)
+
+    def release(self, latency, ok):
+        with self._cond:
+            self.inflight -= 1
+            if self.enabled and ok is not None:
+                self._observe(latency, ok)
+            self._cond.notify_all()
+
+    def slot(self):
+        """with concurrency.slot(): 占一个名额并在结束时记录延迟与结果"""
+        return _Slot(self)
+
+    def _observe(self, latency, ok):
+        if ok:
+            self._latencies.append(latency)
+        else:
+            self._errors += 1
+        if len(self._latencies) + self._errors < max(10, 2 * int(self.limit)):
+            return
+        old = int(self.limit)
+        p50 = sorted(self._latencies)[len(self._latencies) // 2] if self._latencies else None
+        if p50 is not None:
+            self.baseline = p50 if self.baseline is None else min(p50, self.baseline * 1.01)
+        if self._errors:
+            self.limit = max(self.low, self.limit * 0.7)
+            reason = f"错误 {self._errors} 次"
+        elif p50 > self.baseline * LATENCY_TOLERANCE:
+            self.limit = max(self.low, self.limit * max(0.5, LATENCY_TOLERANCE * self.baseline / p50))
+            reason = f"延迟 {p50 * 1000:.0f}ms，基线 {self.baseline * 1000:.0f}ms"
+        elif self._peak >= old:
+            self.limit = min(self.high, self.limit + 1)
+            reason = f"延迟 {p50 * 1000:.0f}ms"
+        else:
+            reason = ""
+        self._reset_window()
+        if int(self.limit) != old:
+            with print_lock:
+                print(f"[auto] 并发 {old} → {int(self.limit)}（{reason}）")
+
+
+class _Slot:
+    def __init__(self, ctl):
+        self.ctl = ctl
+
+    def __enter__(self):
+        self.ctl.acquire()
+        self.start = time.monotonic()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.ctl.release(time.monotonic() - self.start, outcome_ok(exc))
+
+
+class AsyncConcurrencyGate:
+    """异步模式下的并发名额：async with gate.slot()，与线程版共用同一个控制器（只在事件循环线程里使用）"""
+
+    def __init__(self, ctl):
+        self.ctl = ctl
+        self.cond = asyncio.Condition()
+
+    def slot(self):
+        return _AsyncSlot(self)
+
+
+class _AsyncSlot:
+    def __init__(self, gate):
+        self.gate = gate
+
+    async def __aenter__(self):
+        async with self.gate.cond:
+            await self.gate.cond.wait_for(self.gate.ctl.try_acquire)
+        self.start = time.monotonic()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.gate.ctl.release(time.monotonic() - self.start, outcome_ok(exc))
+        # 上限只在 release 时调整，每次释放后唤醒等待者即可
+        async with self.gate.cond:
+            self.gate.cond.notify_all()
+
+
+concurrency = AdaptiveConcurrency(MAX_WORKERS, MIN_CONCURRENCY, MAX_CONCURRENCY, AUTO_TUNE)
+
+
+retry_budget = RetryBudget(RETRY_BUDGET, RETRY_BUDGET_MIN)
+circuit_breaker = CircuitBreaker(BREAKER_WINDOW, BREAKER_MIN_SAMPLES, BREAKER_THRESHOLD,
+                                 BREAKER_COOLDOWN, BREAKER_COOLDOWN_MAX)
+
+
+# 本进程内应答过 4xx（429 除外）的帖子 tid：内链章节据此区分「已不存在」与「这次没下载到」
+gone_tids = set()
+
+
+def after_failure(url, attempt, error, code):
+    """请求失败后的统一处理：记入 tid 索引与熔断器，返回重试前的等待秒数；不再重试时返回 None"""
+    if code is not None and 400 <= code < 500 and code != 429:
+        record_tid(url, str(code))
+        if "act=threadview" in url:
+            gone_tids.add(tid_of(url))
+    retryable = is_retryable(code, error)
+    if code is None:
+        metrics.inc("http_errors_total", error=type(error).__name__)
+    error = str(error) or repr(error)
+    # 永久错误（如 404）说明服务器正常应答，不算失败
+    circuit_breaker.record(not retryable)
+    if not retryable:
+        reason = "不重试"
+    elif attempt + 1 >= RETRY:
+        reason = f"已尝试 {RETRY} 次，放弃"
+    elif not retry_budget.withdraw():
+        reason = "重试预算用尽，放弃"
+    else:
+        delay = backoff(attempt)
+        metrics.inc("http_retries_total")
+        with print_lock:
+            print(f"[warn] get {url} error: {error}  {delay:.1f}s 后重试 {attempt + 1}/{RETRY - 1}...")
+        return delay
+    metrics.inc("http_giveups_total")
+    with print_lock:
+        print(f"[warn] get {url} error: {error}  {reason}")
+    return None
+
+
+# ---------- 磁盘缓存（条件请求 + LRU 淘汰） ----------
+class HttpCache:
+    """按 URL 保存压缩后的页面正文和 ETag/Last-Modified，命中时本地返回或发条件请求"""
+
+    def __init__(self, root, max_bytes, max_age, enabled=True):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.enabled = enabled
+        self.stats = {"hit": 0, "revalidated": 0, "miss": 0}
+        self._size = None
+        self._lock = Lock()
+
+    def _path(self, url):
+        h = hashlib.sha1(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.root, h[:2], h)
+
+    def count(self, kind):
+        with self._lock:
+            self.stats[kind] += 1
+        metrics.inc("cache_requests_total", result=kind)
+
+    def load(self, url):
+        """读取缓存条目，返回 dict（含 body 字节）或 None"""
+        if not self.enabled:
+            return None
+        try:
+            with open(self._path(url), "rb") as f:
+                meta = json.loads(f.readline())
+                raw = f.read()
+            if meta.get("url") != url:
+                return None
+            meta["raw"] = raw
+            meta["body"] = zlib.decompress(raw)
+            return meta
+        except (OSError, ValueError, zlib.error):
+            return None
+
+    @staticmethod
+    def is_fresh(entry, max_age):
+        return time.time() - entry["stored"] <= max_age
+
+    @staticmethod
+    def validators(entry):
+        """生成条件请求头"""
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def touch(self, url):
+        """命中时刷新访问时间（LRU 依据）"""
+        try:
+            os.utime(self._path(url))
+        except OSError:
+            pass
+
+    def store(self, url, body, headers, raw=None):
+        if not self.enabled:
+            return
+        meta = {"url": url, "stored": time.time(),
+                "etag": headers.get("ETag"), "last_modified": headers.get("Last-Modified")}
+        data = json.dumps(meta).encode("utf-8") + b"\n" + (raw if raw is not None else zlib.compress(body, 6))
+        path = self._path(url)
+        tmp = f"{path}.{os.getpid()}.{get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp, "wb") as f:
+                f.write(data)
+            try:
+                # 覆盖已有条目（重新验证、重新下载）时只计大小的差值
+                old = os.path.getsize(path)
+            except OSError:
+                old = 0
+            os.replace(tmp, path)
+        except OSError as e:
+            with print_lock:
+                print(f"[warn] 写缓存失败 {url}: {e}")
+            return
+        with self._lock:
+            if self._size is not None:
+                self._size += len(data) - old
+            over = self._size is None or self._size > self.max_bytes
+        if over:
+            self.evict()
+
+    def refresh(self, url, entry, headers):
+        """304 响应：沿用原正文，更新存储时间和校验头"""
+        self.store(url, entry["body"], {
+            "ETag": headers.get("ETag") or entry.get("etag"),
+            "Last-Modified": headers.get("Last-Modified") or entry.get("last_modified"),
+        }, raw=entry["raw"])
+
+    def evict(self):
+        """删除过期条目；总大小超限时按最近使用时间从旧到新淘汰到 90%"""
+        if not os.path.isdir(self.root):
+            return
+        entries = []
+        for sub in os.scandir(self.root):
+            if not sub.is_dir():
+                continue
+            for e in os.scandir(sub.path):
+                try:
+                    st = e.stat()
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, e.path))
+        now = time.time()
+        total = sum(size for _, size, _ in entries)
+        entries.sort()
+        for mtime, size, path in entries:
+            if now - mtime <= self.max_age and total <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        with self._lock:
+            self._size = total
+
+    def report(self):
+        if not self.enabled:
+            return
+        st = self.stats
+        print(f"[cache] 命中 {st['hit']}，重新验证 {st['revalidated']}，未命中 {st['miss']}")
+        with self._lock:
+            self.stats = dict.fromkeys(self.stats, 0)
+
+
+http_cache = HttpCache(CACHE_DIR, CACHE_MAX_BYTES, CACHE_MAX_AGE, enabled=CACHE_ENABLED)
+
+
+# ---------- SQLite 存储（后台线程批量提交） ----------
+class SqliteStore:
+    """工作线程只把记录放进队列，由后台线程批量写入；读取用每个线程自己的连接，
+    WAL 模式下读写互不阻塞。子类提供 SCHEMA 与 INSERT。
+    """
+    BATCH = 500
+    SCHEMA = ()
+    INSERT = ""
+
+    def __init__(self, path, enabled=True):
+        self.path = path
+        self.enabled = enabled
+        self._queue = queue.Queue()
+        self._local = local()
+        self._writer = None
+        self._lock = Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _start(self):
+        with self._lock:
+            if self._writer is not None:
+                return
+            conn = self._connect()
+            for sql in self.SCHEMA:
+                conn.execute(sql)
+            conn.commit()
+            self._prepare(conn)
+            conn.close()
+            self._writer = Thread(target=self._write_loop, name=type(self).__name__, daemon=True)
+            self._writer.start()
+
+    def _prepare(self, conn):
+        """建表后、后台写线程启动前的初始化"""
+
+    def _reader(self):
+        self._start()
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    def _write_loop(self):
+        conn = self._connect()
+        while True:
+            rows, waiters = [], []
+            item = self._queue.get()
+            while True:
+                if isinstance(item, Event):
+                    waiters.append(item)
+                else:
+                    rows.append(item)
+                if len(rows) >= self.BATCH:
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            if rows:
+                conn.executemany(self.INSERT, rows)
+                conn.commit()
+            for w in waiters:
+                w.set()
+
+    def _put(self, row):
+        self._start()
+        self._queue.put(row)
+
+    def flush(self):
+        """等待队列中的记录全部落盘"""
+        if not self.enabled or self._writer is None:
+            return
+        done = Event()
+        self._queue.put(done)
+        done.wait()
+
+
+# ---------- tid 索引（SQLite，跨书、跨运行共享） ----------
+class TidIndex(SqliteStore):
+    """记录每个 tid 的标题前缀、抓取时间、大小和状态（ok / redirect / 4xx 状态码）"""
+    SCHEMA = ("CREATE TABLE IF NOT EXISTS tids (tid INTEGER PRIMARY KEY, prefix TEXT,"
+              " fetched REAL, size INTEGER, status TEXT)",
+              "CREATE INDEX IF NOT EXISTS tids_prefix ON tids (prefix, tid)")
+    INSERT = "INSERT OR REPLACE INTO tids VALUES (?, ?, ?, ?, ?)"
+
+    def record(self, tid, prefix, size, status):
+        if not self.enabled:
+            return
+        self._put((tid, prefix, time.time(), size, status))
+
+    def lookup_range(self, lo, hi):
+        """返回 [lo, hi] 内已知可访问的 tid：{tid: 前缀}"""
+        if not self.enabled:
+            return {}
+        rows = self._reader().execute(
+            "SELECT tid, prefix FROM tids WHERE tid BETWEEN ? AND ? AND status IN ('ok', 'redirect')",
+            (lo, hi)).fetchall()
+        return dict(rows)
+
+    def next_with_prefix(self, prefix, after):
+        """tid 大于 after 且前缀为 prefix 的第一个 tid，没有则返回 None"""
+        if not self.enabled:
+            return None
+        row = self._reader().execute(
+            "SELECT tid FROM tids WHERE prefix = ? AND tid > ? AND status = 'ok' ORDER BY tid LIMIT 1",
+            (prefix, after)).fetchone()
+        return row[0] if row else None
+
+
+class KnownTids:
+    """一次探测循环内按段批量读取 tid 索引，避免逐个查询"""
+    SPAN = 256
+
+    def __init__(self, index):
+        self.index = index
+        self._lo = self._hi = None
+        self._rows = {}
+
+    def foreign_prefix(self, tid, base_prefix):
+        """索引里已知该 tid 属于别的书时返回它的前缀，否则返回 None（需要联网）"""
+        if self._lo is None or not self._lo <= tid <= self._hi:
+            self._lo, self._hi = tid, tid + self.SPAN - 1
+            self._rows = self.index.lookup_range(self._lo, self._hi)
+        prefix = self._rows.get(tid)
+        return prefix if prefix is not None and prefix != base_prefix else None
+
+
+tid_index = TidIndex(TID_INDEX_DB, enabled=TID_INDEX_ENABLED)
+
+
+def record_tid(url, status, prefix=None, size=None):
+    """帖子页的抓取结果写入 tid 索引（目录页等其它 URL 忽略）"""
+    if "act=threadview" not in url:
+        return
+    tid = tid_of(url)
+    if tid:
+        tid_index.record(tid, prefix, size, status)
+
+
+# ---------- 书目状态库 ----------
+class StateStore(SqliteStore):
+    """每本书一行：标题、首 tid、状态（downloading / done / failed）、加入与更新时间。
+
+    启动时整表读入内存字典，成员判断 O(1)；写入走后台批量提交，与输出文件的改名不同步，
+    崩溃时库里可能缺最后一批状态。两种情况都能自愈：输出文件已改名而库里没记 done 的，
+    下次扫到时由 plan_page 补记为 done；downloading 没落盘的，输出文件也还不存在，下次更新照常当新书抓。
+    启动时把 main.list / temp.list 中状态库没有的书（首次使用或同步版新增）导入。
+    """
+    SCHEMA = ("CREATE TABLE IF NOT EXISTS books (title TEXT PRIMARY KEY, tid INTEGER,"
+              " status TEXT, added REAL, updated REAL)",)
+    INSERT = "INSERT OR REPLACE INTO books VALUES (?, ?, ?, ?, ?)"
+
+    def __init__(self, path, main_list=MAIN_LIST, temp_list=TEMP_LIST):
+        super().__init__(path)
+        self.main_list = main_list
+        self.temp_list = temp_list
+        self._books = {}
+
+    def _prepare(self, conn):
+        self._books = {row[0]: row for row in conn.execute("SELECT * FROM books")}
+        rows = self._import_lists()
+        if rows:
+            conn.executemany(self.INSERT, rows)
+            conn.commit()
+            self._books.update((row[0], row) for row in rows)
+            print(f"[state] 已从列表文件导入 {len(rows)} 本")
+
+    def _import_lists(self):
+        # 合并后的列表最新的在前；倒序赋时间，保证导出顺序不变
+        titles = dict.fromkeys(read_list(self.temp_list) + read_list(self.main_list))
+        titles = [t for t in titles if t not in self._books]
+        now = time.time()
+        return [(t, None, "done", now - i * 1e-3, now) for i, t in enumerate(titles)]
+
+    def __contains__(self, title):
+        self._start()
+        return title in self._books
+
+    def status(self, title):
+        self._start()
+        row = self._books.get(title)
+        return row[2] if row else None
+
+    def mark(self, title, status, tid=None):
+        self._start()
+        now = time.time()
+        with self._lock:
+            old = self._books.get(title)
+            row = (title, tid if tid is not None else (old[1] if old else None),
+                   status, old[3] if old else now, now)
+            self._books[title] = row
+        self._put(row)
+
+    def tid(self, title):
+        self._start()
+        row = self._books.get(title)
+        return row[1] if row else None
+
+    def reload(self):
+        """重新读入整表（分布式抓取时别的节点也在写同一个状态库）"""
+        self.flush()
+        conn = self._connect()
+        rows = {row[0]: row for row in conn.execute("SELECT * FROM books")}
+        conn.close()
+        with self._lock:
+            self._books = rows
+
+    def titles(self, status="done"):
+        """指定状态的书名（status 为 None 时为全部），最新加入的在前"""
+        self._start()
+        with self._lock:
+            rows = [r for r in self._books.values() if status is None or r[2] == status]
+        return [r[0] for r in sorted(rows, key=lambda r: r[3], reverse=True)]
+
+    def export_list(self, path):
+        """把已完成书目写成 main.list（供同步版与人工查看），原子替换"""
+        tmp = f"{path}.{os.getpid()}.tmp"
+        write_list(tmp, self.titles("done"))
+        os.replace(tmp, path)
+
+
+state_store = StateStore(STATE_DB)
+
+
+# ---------- 分布式任务队列（租约） ----------
+Job = namedtuple("Job", "id kind payload attempts")
+
+
+class WorkQueue:
+    """多个节点共享的任务队列。任务 (id, kind, payload, priority) 发布后排队，节点领取时拿到
+    带期限的租约并定期续租，完成或失败后释放；租约过期的任务重新排队，交给别的节点。
+
+    换成别的存储（Redis、数据库服务等）只需实现这些方法，并登记到 WORK_QUEUE_BACKENDS。
+    """
+
+    def publish(self, jobs):
+        """jobs 为 [(id, kind, payload, priority)]；id 已存在的任务忽略（同一轮里只做一次）"""
+        raise NotImplementedError
+
+    def claim(self, node, ttl):
+        """领取优先级最高（数值最小）、最早发布的排队任务，返回 Job；没有时返回 None"""
+        raise NotImplementedError
+
+    def renew(self, node, ids, ttl):
+        """续租，返回仍由本节点持有的任务 id 集合"""
+        raise NotImplementedError
+
+    def complete(self, node, job_id):
+        """完成；租约已不属于本节点（过期后被别人领走）时返回 False"""
+        raise NotImplementedError
+
+    def fail(self, node, job_id, error):
+        """失败：未超过次数上限时重新排队"""
+        raise NotImplementedError
+
+    def beat(self, node, ttl):
+        """节点心跳，返回当前在线节点数"""
+        raise NotImplementedError
+
+    def leave(self, node):
+        raise NotImplementedError
+
+    def counts(self):
+        """各状态（queued / leased / done / failed）的任务数"""
+        raise NotImplementedError
+
+    def reset(self):
+        """开始新一轮：清掉上一轮的记录（仍在租约中的任务保留）"""
+        raise NotImplementedError
+
+
+class SqliteWorkQueue(WorkQueue):
+    """SQLite 实现：领取在 BEGIN IMMEDIATE 事务里完成，靠数据库文件锁保证多个进程不会领到同一个任务。
+    适合同一台机器上的多个进程，或放在支持文件锁的共享目录里。
+    """
+    SCHEMA = ("CREATE TABLE IF NOT EXISTS jobs (seq INTEGER PRIMARY KEY, id TEXT UNIQUE, kind TEXT,"
+              " payload TEXT, priority INTEGER, state TEXT, owner TEXT, lease_until REAL,"
+              " attempts INTEGER, error TEXT, updated REAL)",
+              "CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, priority, seq)",
+              "CREATE TABLE IF NOT EXISTS nodes (node TEXT PRIMARY KEY, seen REAL)")
+
+    def __init__(self, path, max_attempts=QUEUE_MAX_ATTEMPTS):
+        self.path = path
+        self.max_attempts = max_attempts
+        self._local = local()
+        with self._tx() as conn:
+            for sql in self.SCHEMA:
+                conn.execute(sql)
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # isolation_level=None：事务由 _tx 显式开始
+            conn = self._local.conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    @contextmanager
+    def _tx(self):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def _expire(self, conn, now):
+        """租约过期的任务算一次失败，重新排队或放弃"""
+        conn.execute("UPDATE jobs SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END,"
+                     " owner = NULL, error = 'lease expired', updated = ?"
+                     " WHERE state = 'leased' AND lease_until < ?", (self.max_attempts, now, now))
+
+    def publish(self, jobs):
+        now = time.time()
+        with self._tx() as conn:
+            conn.executemany("INSERT OR IGNORE INTO jobs (id, kind, payload, priority, state, attempts, updated)"
+                             " VALUES (?, ?, ?, ?, 'queued', 0, ?)",
+                             [(i, kind, json.dumps(payload, ensure_ascii=False), prio, now)
+                              for i, kind, payload, prio in jobs])
+
+    def claim(self, node, ttl):
+        now = time.time()
+        with self._tx() as conn:
+            self._expire(conn, now)
+            row = conn.execute("SELECT id, kind, payload, attempts FROM jobs WHERE state = 'queued'"
+                               " ORDER BY priority, seq LIMIT 1").fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE jobs SET state = 'leased', owner = ?, lease_until = ?, attempts = attempts + 1,"
+                         " updated = ? WHERE id = ?", (node, now + ttl, now, row[0]))
+        return Job(row[0], row[1], json.loads(row[2]), row[3] + 1)
+
+    def renew(self, node, ids, ttl):
+        now = time.time()
+        kept = set()
+        with self._tx() as conn:
+            for i in ids:
+                cur = conn.execute("UPDATE jobs SET lease_until = ? WHERE id = ? AND owner = ? AND state = 'leased'",
+                                   (now + ttl, i, node))
+                if cur.rowcount:
+                    kept.add(i)
+        return kept
+
+    def _release(self, node, job_id, state, error=None):
+        with self._tx() as conn:
+            cur = conn.execute("UPDATE jobs SET state = ?, owner = NULL, error = ?, updated = ?"
+                               " WHERE id = ? AND owner = ? AND state = 'leased'",
+                               (state, error, time.time(), job_id, node))
+            return cur.rowcount == 1
+
+    def complete(self, node, job_id):
+        return self._release(node, job_id, "done")
+
+    def fail(self, node, job_id, error):
+        with self._tx() as conn:
+            row = conn.execute("SELECT attempts FROM jobs WHERE id = ? AND owner = ? AND state = 'leased'",
+                               (job_id, node)).fetchone()
+            if row is None:
+                return False
+            state = "failed" if row[0] >= self.max_attempts else "queued"
+            conn.execute("UPDATE jobs SET state = ?, owner = NULL, error = ?, updated = ? WHERE id = ?",
+                         (state, error, time.time(), job_id))
+        return True
+
+    def beat(self, node, ttl):
+        now = time.time()
+        with self._tx() as conn:
+            conn.execute("INSERT OR REPLACE INTO nodes VALUES (?, ?)", (node, now))
+            conn.execute("DELETE FROM nodes WHERE seen < ?", (now - ttl,))
+            return conn.execute("SELECT COUNT(*) FROM nodes").fetchone()[0]
+
+    def leave(self, node):
+        with self._tx() as conn:
+            conn.execute("DELETE FROM nodes WHERE node = ?", (node,))
+
+    def counts(self):
+        with self._tx() as conn:
+            self._expire(conn, time.time())
+            return dict(conn.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+
+    def reset(self):
+        with self._tx() as conn:
+            conn.execute("DELETE FROM jobs WHERE state != 'leased'")
+
+
+WORK_QUEUE_BACKENDS = {"sqlite": SqliteWorkQueue}
+
+
+def open_work_queue():
+    return WORK_QUEUE_BACKENDS[QUEUE_BACKEND](QUEUE_DB)
+
+
+def request_kind(url, base_prefix=None):
+    """指标里的请求类别：目录页 index、tid 探测 probe、其余帖子页 thread"""
+    if "act=gold" in url:
+        return "index"
+    return "thread" if base_prefix is None else "probe"
+
+
+def cache_max_age(url):
+    """目录页总是重新验证，帖子页在有效期内直接用缓存"""
+    return CACHE_FRESH_INDEX if "act=gold" in url else CACHE_FRESH_THREAD
+
+
+class HeadScanner:
+    """逐块累积页头，判断 <title>…</title> 是否已经完整到达"""
+
+    def __init__(self):
+        self.parts = []
+        self._tail = b""
+
+    def feed(self, chunk):
+        self.parts.append(chunk)
+        window = (self._tail + chunk).lower()
+        self._tail = window[-7:]
+        # 先用字节查找做廉价判断，命中后再按 extract_title 的规则确认
+        if b"</title>" not in window:
+            return False
+        return TITLE_BYTES_RE.search(self.head()) is not None
+
+    def head(self):
+        return b"".join(self.parts)
+
+
+def read_probe(chunks, base_prefix):
+    """探测读取：chunks 为字节块迭代器，读到 </title> 即判定前缀。
+    前缀不一致返回 (None, 前缀)，一致则继续读完整页返回 (正文字节, 前缀)"""
+    scanner = HeadScanner()
+    for chunk in chunks:
+        if scanner.feed(chunk):
+            break
+    prefix = extract_title(scanner.head())
+    if prefix != base_prefix:
+        # 截断的请求只在这里知道读了多少字节
+        metrics.inc("http_bytes_total", sum(map(len, scanner.parts)), kind="probe")
+        return None, prefix
+    scanner.parts.extend(chunks)
+    return b"".join(scanner.parts), prefix
+
+
+def decode_body(body):
+    with metrics.timer("stage_seconds", stage="decode"):
+        return body.decode("utf-8", errors="replace")
+
+
+def fetch_body(url, max_age=None, base_prefix=None):
+    """get_body / get_html 的核心，返回 (正文字节, 截断时的前缀)；正文是解压后、未解码的 UTF-8 字节。
+
+    base_prefix 不为 None 时为 tid 探测：流式读取到 </title> 就比较前缀，
+    不一致立即断开连接并返回 (None, 前缀)，不下载剩余正文。
+    """
+    entry = http_cache.load(url)
+    if entry is not None:
+        if max_age is None:
+            max_age = cache_max_age(url)
+        if http_cache.is_fresh(entry, max_age):
+            http_cache.count("hit")
+            http_cache.touch(url)
+            return entry["body"], None
+    kind = request_kind(url, base_prefix)
+    for attempt in range(RETRY):
+        circuit_breaker.wait()
+        rate_limiter.acquire(url)
+        if attempt == 0:
+            retry_budget.deposit()
+        r = None
+        try:
+            headers = http_cache.validators(entry) if entry else None
+            with concurrency.slot():
+                start = time.perf_counter()
+                try:
+                    with session.get(url, timeout=TIMEOUT, headers=headers, stream=base_prefix is not None) as r:
+                        # elapsed 是发出请求到解析完响应头（含建连、TLS 与等待首字节）
+                        metrics.observe("http_ttfb_seconds", r.elapsed.total_seconds(), kind=kind)
+                        metrics.inc("http_requests_total", kind=kind, status=r.status_code)
+                        if r.status_code in (429, 503):
+                            rate_limiter.throttled(url, parse_retry_after(r.headers.get("Retry-After")))
+                        else:
+                            rate_limiter.succeeded(url)
+                        if r.status_code < 400:
+                            circuit_breaker.record(True)
+                        if r.status_code == 304 and entry is not None:
+                            http_cache.count("revalidated")
+                            http_cache.refresh(url, entry, r.headers)
+                            return entry["body"], None
+                        r.raise_for_status()
+                        status = "redirect" if r.history else "ok"
+                        if base_prefix is None:
+                            body = r.content
+                        else:
+                            body, prefix = read_probe(r.iter_content(PROBE_CHUNK), base_prefix)
+                            if body is None:
+                                record_tid(url, status, prefix, r.headers.get("Content-Length"))
+                                return None, prefix
+                finally:
+                    metrics.observe("http_request_seconds", time.perf_counter() - start, kind=kind)
+                    if r is not None:
+                        # 线路上实际读到的字节（压缩传输时小于正文）
+                        metrics.inc("http_wire_bytes_total", r.raw.tell(), kind=kind)
+            metrics.inc("http_bytes_total", len(body), kind=kind)
+            http_cache.count("miss")
+            http_cache.store(url, body, r.headers)
+            record_tid(url, status, extract_title(body), len(body))
+            return body, None
+        except requests.exceptions.RequestException as e:
+            delay = after_failure(url, attempt, e, getattr(e.response, "status_code", None))
+            if delay is None:
+                break
+            time.sleep(delay)
+        except Exception as e:
+            with print_lock:
+                print(f"[error] Unexpected error: {e}")
+            break
+    return None, None
+
+
+def get_body(url, max_age=None):
+    """只要标题与正文的页面（章节页）用字节版，解析时只解码正文块"""
+    return fetch_body(url, max_age)[0]
+
+
+def get_html(url, max_age=None):
+    """线程安全的HTML获取函数（带磁盘缓存）；需要整页查找链接的目录页与首页用它"""
+    body = fetch_body(url, max_age)[0]
+    return decode_body(body) if body is not None else None
+
+
+# ---------- 工具函数 ----------
+def safe_filename(name):
+    name = re.sub(r'<[^>]+>', '', name)
+    name = re.sub(r'[\\/:*?"<>|\s]', '_', name)
+    return name.strip('. ') or 'untitled'
+
+
+def read_list(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r', encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def write_list(path, lst):
+    with open(path, 'w', encoding='utf-8') as f:
+        for s in lst:
+            f.write(s + '\n')
+
+
+# 标题与正文定位用的正则只编译一次。
+# 标题有字节版，直接在未解码的页面上查找，只解码 <title> 的内容：标签两侧都是 ASCII 的 < >，
+# 切出的片段解码后与整页解码再切完全相同（字节正则的 re.I 只折叠 ASCII 字母，实际页面不会用 ı、ſ 之类的字符拼标签名）
+TITLE_RE = re.compile(r'<title>(.*?)</title>', re.I | re.S)
+TITLE_BYTES_RE = re.compile(rb'<title>(.*?)</title>', re.I | re.S)
+QUOTE_OPEN_RE = re.compile(r'<div[^>]*class=["\']quote["\'][^>]*>', re.I)
+DIV_OPEN_RE = re.compile(r'<div[^>]*>', re.I)
+DIV_CLOSE_RE = re.compile(r'</div>', re.I)
+BR_RE = re.compile(r'<br\s*/?>', re.I)
+TAG_RE = re.compile(r'<[^>]+>')
+
+
+def extract_title(html):
+    """html 为 str 或 UTF-8 字节；字节时只解码 <title> 的内容"""
+    if isinstance(html, bytes):
+        m = TITLE_BYTES_RE.search(html)
+        raw = m.group(1).decode("utf-8", errors="replace") if m else None
+    else:
+        m = TITLE_RE.search(html)
+        raw = m.group(1) if m else None
+    if raw is None:
+        return ""
+    return re.split(r'[（(]', raw.strip(), maxsplit=1)[0].strip()[:30]
+
+
+def div_blocks(html, open_re):
+    """逐个返回 div 内容的 (起, 止) 位置，与 findall(开标签 + r'(.*?)</div>') 的结果一一对应。
+
+    开标签只能在它之后第一个 > 处结束，内容就到其后第一个 </div>；
+    直接定位这两处，不用懒惰匹配逐字符试探，找不到 </div> 即可停止，不会对每个 <div 扫到文末。
+    """
+    pos = 0
+    while True:
+        m = open_re.search(html, pos)
+        if not m:
+            return
+        close = DIV_CLOSE_RE.search(html, m.end())
+        if not close:
+            return
+        yield m.end(), close.start()
+        pos = close.end()
+
+
+def html_to_text(fragment):
+    """<br> 转换行，再去掉其余标签"""
+    return TAG_RE.sub('', BR_RE.sub('\n', fragment))
+
+
+def extract_text(html):
+    """html 为 str 或 UTF-8 字节。
+
+    字节时先整页解码再定位正文：中文在 UTF-8 里占 3 字节、在 str 里占 2 字节，
+    正则在字节上扫描反而更慢，实测整页解码（约 1 GB/s）加 str 正则比只解码正文块还快。
+    """
+    if isinstance(html, bytes):
+        html = decode_body(html)
+    with metrics.timer("stage_seconds", stage="extract"):
+        txt = [html_to_text(html[start:end]) for start, end in div_blocks(html, QUOTE_OPEN_RE)]
+        if not txt:
+            # 只比较跨度选出最长的 div（同长取第一个），不复制其余 div 的内容
+            longest = max(div_blocks(html, DIV_OPEN_RE), key=lambda b: b[1] - b[0], default=None)
+            if longest:
+                txt.append(html_to_text(html[longest[0]:longest[1]]))
+        return "\n".join(txt).strip()
+
+
+def list_novels_one_page(html):
+    novels = []
+    for url, tid, title in re.findall(r'<a\s+href=["\']([^"\']*tid=(\d+)[^"\']*)["\'][^>]*>(.*?)</a>', html, flags=re.I):
+        if "act=thread" in url or "act=threadview" in url:
+            title = safe_filename(title.strip())
+            novels.append({"title": title, "url": urljoin(BASE_URL, url), "tid": int(tid)})
+    seen = set(); res = []
+    for n in novels:
+        if n["tid"] not in seen:
+            seen.add(n["tid"])
+            res.append(n)
+    return res
+
+
+HALF_SPACES_RE = re.compile(r'  +')
+FULL_SPACES_RE = re.compile(r'　　+')
+ANY_SPACES_RE = re.compile(r'[ \u00A0\u3000]+')
+
+
+def titles_overlap(titles):
+    """任意两个标题（含自身）能否在文本中重叠出现：一个是另一个的子串，或前者的后缀是后者的前缀"""
+    prefixes = {t[:i] for t in titles for i in range(1, len(t) + 1)}
+    for t in titles:
+        if any(t[i:] in prefixes for i in range(1, len(t))):
+            return True
+        if any(t[i:j] in titles for i in range(len(t)) for j in range(i + 1, len(t) + 1) if (i, j) != (0, len(t))):
+            return True
+    return False
+
+
+def trie_regex(words):
+    """把一组互不为前缀的字符串编成按公共前缀合并的正则，匹配时每个位置只沿一条路径比较"""
+    trie = {}
+    for w in words:
+        node = trie
+        for ch in w:
+            node = node.setdefault(ch, {})
+
+    def build(node):
+        alts = [re.escape(ch) + build(child) for ch, child in sorted(node.items())]
+        if len(alts) <= 1:
+            return "".join(alts)
+        return "(?:" + "|".join(alts) + ")"
+    return build(trie)
+
+
+def compile_title_remover(inner_titles):
+    """返回 remove(text)，效果与依次执行 text = text.replace(t, '') 相同。
+
+    标题两两不重叠时，各标题在原文中的出现互不相交，一次正则扫描即可全部删除；
+    只有删除后拼接出新标题时两种做法才会不同，此时结果里必然还能找到标题，退回逐个替换。
+    """
+    titles = set(t for t in inner_titles if t)
+    if not titles:
+        return lambda text: text
+    pattern = None if titles_overlap(titles) else re.compile(trie_regex(titles))
+
+    def sequential(text):
+        for t in inner_titles:
+            text = text.replace(t, '')
+        return text
+
+    def remove(text):
+        if pattern is None:
+            return sequential(text)
+        result = pattern.sub('', text)
+        return sequential(text) if pattern.search(result) else result
+    return remove
+
+
+def make_cleaner(inner_titles):
+    """预先编译好标题删除，返回 clean(text)，与 clean_final(text, inner_titles) 结果相同"""
+    remove_titles = compile_title_remover(inner_titles)
+
+    def clean(text):
+        with metrics.timer("stage_seconds", stage="clean"):
+            # 1. 连续两个半角空格 -> 硬回车+两个半角空格
+            text = HALF_SPACES_RE.sub('\n  ', text)
+            # 2. 连续两个全角空格 -> 硬回车+两个全角空格
+            text = FULL_SPACES_RE.sub('\n　　', text)
+            # 3. 删除内链标题
+            text = remove_titles(text)
+            # 4. 删除所有半角/全角空格
+            text = ANY_SPACES_RE.sub('', text)
+            # 5. 删除纯空段，6. 每段前加两个全角空格
+            return '\n'.join('　　' + ln for ln in text.splitlines() if ln.strip())
+    return clean
+
+
+def clean_final(text: str, inner_titles: list) -> str:
+    return make_cleaner(inner_titles)(text)
+
+
+# ---------- 章节去重（内容指纹） ----------
+DEDUP_SPACE_RE = re.compile(r'[ \t\r\f\v\u00A0\u3000]+')
+DEDUP_SENTENCE_RE = re.compile(r'[^。！？!?…\n]+(?:[。！？!?…]+[」』”’]*)?')
+
+
+def fingerprint(text):
+    """章节指纹 (精确哈希, 64 位 SimHash, 字数)；去掉空白后计算，排版不同的转载也能认出。
+
+    SimHash 以句子为特征、按字数加权：转载时加了头尾说明、改了个别句子或重新分段，指纹仍然相近。
+    （以整段为特征时段落少的章节各位票数常常接近打平，一行短短的转载说明就能翻转好几位。）
+    """
+    lines = [line for line in DEDUP_SPACE_RE.sub("", text).split("\n") if line]
+    if not lines:
+        return None
+    joined = "\n".join(lines)
+    exact = hashlib.blake2b(joined.encode("utf-8"), digest_size=16).hexdigest()
+    groups = {}
+    for sentence in DEDUP_SENTENCE_RE.findall(joined):
+        h = hashlib.blake2b(sentence.encode("utf-8"), digest_size=8).digest()
+        groups.setdefault(len(sentence), []).append(format(int.from_bytes(h, "big"), "064b"))
+    # 字数相同的特征位串拼在一起，第 i 位的票数就是步长 64 的切片里 1 的个数，不必逐位循环
+    votes = [0] * 64
+    for weight, bits in groups.items():
+        column = "".join(bits)
+        for i in range(64):
+            votes[i] += weight * (2 * column[i::64].count("1") - len(bits))
+    sim = int("".join("1" if v > 0 else "0" for v in votes), 2)
+    return exact, sim, sum(map(len, lines))
+
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+def simhash_bands(sim):
+    """64 位切成 4 段：汉明距离不超过 3 的两个指纹至少有一段完全相同"""
+    return [(sim >> shift) & 0xFFFF for shift in (48, 32, 16, 0)]
+
+
+class FingerprintIndex(SqliteStore):
+    """每本书的每个章节 tid 一行：指纹，以及重复时保留的那一章的 tid（dup_of）。
+    同一个 tid 可能同时属于两本书（转载、合集），所以以 (tid, 书名) 为主键，互不覆盖。
+    """
+    SCHEMA = ("CREATE TABLE IF NOT EXISTS chapters (tid INTEGER, title TEXT, hash TEXT,"
+              " simhash INTEGER, size INTEGER, b0 INTEGER, b1 INTEGER, b2 INTEGER, b3 INTEGER, dup_of INTEGER,"
+              " PRIMARY KEY (tid, title))",
+              "CREATE INDEX IF NOT EXISTS chapters_title ON chapters (title)",
+              "CREATE INDEX IF NOT EXISTS chapters_hash ON chapters (hash)",
+              "CREATE INDEX IF NOT EXISTS chapters_b0 ON chapters (b0)",
+              "CREATE INDEX IF NOT EXISTS chapters_b1 ON chapters (b1)",
+              "CREATE INDEX IF NOT EXISTS chapters_b2 ON chapters (b2)",
+              "CREATE INDEX IF NOT EXISTS chapters_b3 ON chapters (b3)")
+    INSERT = "INSERT OR REPLACE INTO chapters VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+
+    def _prepare(self, conn):
+        pk = [row[1] for row in conn.execute("PRAGMA table_info(chapters)") if row[5]]
+        if pk != ["tid"]:
+            return
+        # 旧库只以 tid 为主键，另一本书记录同一 tid 时会覆盖这本书的记录：改表结构，保留已有行
+        conn.execute("ALTER TABLE chapters RENAME TO chapters_old")
+        for name in ("title", "hash", "b0", "b1", "b2", "b3"):
+            conn.execute(f"DROP INDEX IF EXISTS chapters_{name}")
+        for sql in self.SCHEMA:
+            conn.execute(sql)
+        conn.execute("INSERT INTO chapters SELECT * FROM chapters_old")
+        conn.execute("DROP TABLE chapters_old")
+        conn.commit()
+
+    def record(self, tid, title, fp, dup_of):
+        """记下 tid 在这本书里的指纹；同一本书里重抓同一 tid 时覆盖旧记录"""
+        exact, sim, size = fp
+        # SQLite 的整数是有符号 64 位
+        signed = sim - (1 << 64) if sim >> 63 else sim
+        self._put((tid, title, exact, signed, size, *simhash_bands(sim), dup_of))
+
+    def kept(self, title):
+        """这本书已写出（未判为重复）的章节：[(tid, 指纹)]"""
+        rows = self._reader().execute("SELECT tid, hash, simhash, size FROM chapters"
+                                      " WHERE title = ? AND dup_of IS NULL", (title,))
+        return [(tid, (h, sim & 0xFFFFFFFFFFFFFFFF, size)) for tid, h, sim, size in rows]
+
+    def dup_of(self, tid, title):
+        row = self._reader().execute("SELECT dup_of FROM chapters WHERE tid = ? AND title = ?",
+                                     (tid, title)).fetchone()
+        return row[0] if row else None
+
+    def find(self, fp, exclude_title):
+        """在别的书已写出的章节里找重复，返回那一章的 tid"""
+        exact, sim, size = fp
+        conn = self._reader()
+        row = conn.execute("SELECT tid FROM chapters WHERE hash = ? AND dup_of IS NULL AND title != ? LIMIT 1",
+                           (exact, exclude_title)).fetchone()
+        if row or size < DEDUP_MIN_CHARS:
+            return row[0] if row else None
+        for k, band in enumerate(simhash_bands(sim)):
+            for tid, other in conn.execute(f"SELECT tid, simhash FROM chapters WHERE b{k} = ?"
+                                           f" AND dup_of IS NULL AND title != ? AND size >= ?",
+                                           (band, exclude_title, DEDUP_MIN_CHARS)):
+                if hamming(sim, other & 0xFFFFFFFFFFFFFFFF) <= DEDUP_DISTANCE:
+                    return tid
+        return None
+
+
+dedup_index = FingerprintIndex(DEDUP_DB, enabled=DEDUP != "off")
+
+
+class ChapterDedup:
+    """一本书的去重状态。写出顺序上先出现的章节保留，之后内容相同或相近的章节（别的 tid）跳过；
+    同一个 tid 重抓（断点续抓）不算重复。新书不沿用指纹库里这本书的旧记录，增量更新与续抓时读入。
+    """
+
+    def __init__(self, index, title, start_tid, fresh, scope):
+        self.index = index
+        self.title = title
+        self.start_tid = start_tid
+        self.scope = scope
+        self._hashes = {}
+        self._sims = []
+        if not fresh:
+            for tid, fp in index.kept(title):
+                self._add(tid, fp)
+
+    def _add(self, tid, fp):
+        self._hashes.setdefault(fp[0], tid)
+        if fp[2] >= DEDUP_MIN_CHARS:
+            self._sims.append((fp[1], tid))
+
+    def _match(self, tid, fp):
+        other = self._hashes.get(fp[0])
+        if other is not None and other != tid:
+            return other
+        if fp[2] >= DEDUP_MIN_CHARS:
+            for sim, other in self._sims:
+                if other != tid and hamming(sim, fp[1]) <= DEDUP_DISTANCE:
+                    return other
+        return None
+
+    def known_dup(self, tid):
+        """上次已判为重复的 tid（属于这本书），不必再下载"""
+        if self.index.dup_of(tid, self.title) is None:
+            return False
+        metrics.inc("dedup_skipped_total", stage="fetch")
+        return True
+
+    def check(self, tid, fp):
+        """按写出顺序调用：重复时返回保留的那一章的 tid，否则记下指纹并返回 None（首页 tid 为 None）"""
+        tid = self.start_tid if tid is None else tid
+        dup = self._match(tid, fp)
+        if dup is None and self.scope == "library":
+            dup = self.index.find(fp, self.title)
+        self.index.record(tid, self.title, fp, dup)
+        if dup is None:
+            self._add(tid, fp)
+        else:
+            metrics.inc("dedup_skipped_total", stage="write")
+        return dup
+
+
+# ---------- 章节清单（增量更新） ----------
+# 每本书一个 JSON 清单：首 tid、抓取模式、已抓章节 tid、最后章节 tid 与最远探测 tid
+def tid_of(url):
+    m = re.search(r'tid=(\d+)', url)
+    return int(m.group(1)) if m else 0
+
+
+def find_inner_links(html, base_url):
+    """解析首页中的内链章节，返回 [(url, 标题)]，保持源码顺序"""
+    inner_links = []
+    for url, txt in re.findall(r'<a\s+href=["\']([^"\']*tid=\d+[^"\']*)["\'][^>]*>([^<]*\d+[^<]*)</a>', html, flags=re.I):
+        full = urljoin(base_url, url)
+        txt = re.sub(r'<[^>]+>', '', txt).strip()
+        if re.search(r'\d+', txt):
+            inner_links.append((full, txt))
+    return inner_links
+
+
+def manifest_path(title):
+    return os.path.join(MANIFEST_DIR, title + ".json")
+
+
+def new_manifest(info):
+    return {"title": info["title"], "start_tid": info["tid"], "mode": None,
+            "fetched": [], "missing": [], "gone": [], "rebuilds": info.get("rebuilds", 0),
+            "last_tid": info["tid"], "probed_tid": info["tid"], "updated": 0}
+
+
+def load_manifest(title):
+    try:
+        with open(manifest_path(title), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_manifest(manifest):
+    """原子写入清单，避免中断时留下半个文件"""
+    manifest["updated"] = int(time.time())
+    if not manifest.get("missing"):
+        manifest["rebuilds"] = 0    # 缺章补齐后，整本重抓的次数从头算
+    path = manifest_path(manifest["title"])
+    tmp = f"{path}.{os.getpid()}.{get_ident()}.tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def record_chapter(manifest, tid):
+    manifest["fetched"].append(tid)
+    if manifest["mode"] == "tid":
+        manifest["last_tid"] = max(manifest["last_tid"], tid)
+
+
+def record_missing(manifest, tid):
+    """内链章节没下载到：应答过 4xx 的记为已不存在（gone），以后不再抓；
+    其余（超时、5xx 等）记为缺章（missing）。缺的章节在书中间，下次更新时整本按顺序重抓，
+    不能当作新章节追加到末尾"""
+    if tid in gone_tids:
+        manifest.setdefault("gone", []).append(tid)
+        with print_lock:
+            print(f"    [gone] tid={tid} 已不存在，跳过")
+        return
+    manifest.setdefault("missing", []).append(tid)
+    with print_lock:
+        print(f"    [missing] tid={tid} 下载失败，下次更新时整本按顺序重抓")
+
+
+def skipped_tids(manifest):
+    """内链模式不再抓取的 tid：已抓到的、已不存在的，以及本轮缺的（要等整本重抓才能放回原位）"""
+    return set(manifest["fetched"]) | set(manifest.get("gone", ())) | set(manifest.get("missing", ()))
+
+
+# ---------- 断点续抓 ----------
+# 新书写到 output/书名.txt.part 时，每写出一章把已写入部分对应的章节 tid 与文件长度
+# 原子写入 list/manifest/书名.part.json。中断（Ctrl+C、崩溃、断电）后再抓这本书时，
+# 把 .part 截断到记录的长度接着写，已写入的章节不再下载。断点还记下每章写完时的长度，续抓时据此还原 epub 的章节。
+def checkpoint_path(title):
+    return os.path.join(MANIFEST_DIR, title + ".part.json")
+
+
+def load_checkpoint(title):
+    """读取断点；.part 比断点记录的短（内容没来得及落盘）时断点无效，返回 None"""
+    try:
+        with open(checkpoint_path(title), 'r', encoding='utf-8') as f:
+            cp = json.load(f)
+        size = os.path.getsize(os.path.join(OUTPUT_DIR, title + ".txt.part"))
+    except (OSError, ValueError):
+        return None
+    return cp if cp.get("written") and size >= cp["part_size"] else None
+
+
+def resume_manifest(info, cp):
+    """由断点还原清单：已写入的章节算作已抓，tid 模式从最后写入的章节之后继续探测"""
+    manifest = new_manifest(info)
+    manifest["fetched"] = list(cp["fetched"])
+    manifest["missing"] = list(cp.get("missing", ()))
+    if cp["mode"] == "tid" and cp["fetched"]:
+        manifest["last_tid"] = manifest["probed_tid"] = max(cp["fetched"])
+    return manifest
+
+
+class Checkpoint:
+    """一本新书的断点，由写出器在每章落盘后调用 save"""
+
+    def __init__(self, manifest, fetched=(), ends=()):
+        self.manifest = manifest
+        self.path = checkpoint_path(manifest["title"])
+        self.fetched = list(fetched)
+        self.ends = None if ends is None else list(ends)   # 旧断点没有这一项时不再记录
+
+    def save(self, tid, size, written):
+        """tid 为刚写入章节的 tid（首页为 None），size 为 .part 当前字节数"""
+        if tid is not None:
+            self.fetched.append(tid)
+        if self.ends is not None:
+            self.ends.append(size)
+        data = {"title": self.manifest["title"], "start_tid": self.manifest["start_tid"],
+                "mode": self.manifest["mode"], "fetched": self.fetched,
+                "missing": list(self.manifest.get("missing", ())),
+                "written": written, "part_size": size, "ends": self.ends}
+        tmp = f"{self.path}.{os.getpid()}.{get_ident()}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def open_writer(info, manifest, inner_titles, bounded=True):
+    """按情况创建写出器，返回 (writer, manifest)：
+    增量更新追加到原文件；新书带断点写出，有有效断点时续写 .part。
+    bounded=False 供异步引擎使用：写出器在事件循环里调用，epub 队列不能满了就阻塞"""
+    title = info["title"]
+    cp = load_checkpoint(title) if CHECKPOINT and manifest is None else None
+    dedup = None
+    if DEDUP != "off":
+        dedup = ChapterDedup(dedup_index, title, info["tid"], fresh=manifest is None and cp is None, scope=DEDUP)
+    epub = open_epub(title, info["tid"], append=manifest is not None, cp=cp, bounded=bounded)
+    if manifest is not None:
+        return BookWriter(title, inner_titles, append=True, dedup=dedup, epub=epub), manifest
+    if cp is None:
+        manifest = new_manifest(info)
+        checkpoint = Checkpoint(manifest) if CHECKPOINT else None
+        return BookWriter(title, inner_titles, checkpoint=checkpoint, dedup=dedup, epub=epub), manifest
+    manifest = resume_manifest(info, cp)
+    with print_lock:
+        print(f"    [resume] 从断点续抓：已写入 {cp['written']} 章")
+    writer = BookWriter(title, inner_titles, checkpoint=Checkpoint(manifest, cp["fetched"], cp.get("ends")),
+                        resume=(cp["part_size"], cp["written"]), dedup=dedup, epub=epub)
+    return writer, manifest
+
+
+# ---------- 打包归档（可选的输出后端） ----------
+# 每次整本保存或增量追加，把 .part 压缩成一块追加到 library.pack，再往 library.idx 追加一行
+# [书名, 首 tid, 偏移, 压缩长度, 原始长度, 压缩方式, crc32, 是否追加]。块先落盘、索引后写，
+# 中途崩溃最多留下一块没有索引的数据；一本书的内容就是它最后一个非追加块及之后各追加块按顺序拼接，
+# 与 txt 后端的文件内容逐字节相同。
+class FileLock:
+    """跨进程的排他锁（锁文件 + flock / msvcrt）；同一进程内的线程先用 Lock 排队"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = Lock()
+        self._f = None
+
+    def __enter__(self):
+        self._lock.acquire()
+        self._f = open(self.path, "a+b")
+        if fcntl is not None:
+            fcntl.flock(self._f, fcntl.LOCK_EX)
+        else:
+            self._f.seek(0)
+            msvcrt.locking(self._f.fileno(), msvcrt.LK_LOCK, 1)
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            if fcntl is not None:
+                fcntl.flock(self._f, fcntl.LOCK_UN)
+            else:
+                self._f.seek(0)
+                msvcrt.locking(self._f.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            self._f.close()
+            self._lock.release()
+
+
+def pack_compressor(codec, level=PACK_LEVEL):
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    return zlib.compressobj(level, zlib.DEFLATED, 31)   # wbits=31：gzip 格式
+
+
+def pack_decompress(codec, data):
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("归档中有 zstd 压缩块，需要 zstandard：pip install zstandard")
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    return zlib.decompress(data, 31)
+
+
+class PackArchive:
+    """打包归档：多个线程 / 进程只追加写（跨进程文件锁），读取用 mmap 按偏移随机访问。
+
+    索引在内存里按书名保存块列表；别的进程追加的索引行在下次查询时增量读入，不需要扫描目录。
+    """
+
+    def __init__(self, path, index_path, codec=PACK_CODEC):
+        self.path = path
+        self.index_path = index_path
+        self.codec = codec
+        self._lock = Lock()
+        self._file_lock = FileLock(path + ".lock")
+        self._books = {}    # 书名 -> {"tid": 首 tid, "chunks": [(偏移, 长度, 原始长度, 压缩方式, crc)]}
+        self._index_pos = 0
+        self._map = None
+
+    def _refresh(self):
+        """读入索引文件新增的完整行（最后一行可能正被别的进程写入）"""
+        try:
+            if os.path.getsize(self.index_path) == self._index_pos:
+                return
+        except OSError:
+            return
+        with open(self.index_path, "rb") as f:
+            f.seek(self._index_pos)
+            data = f.read()
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].splitlines():
+            try:
+                title, tid, offset, length, size, codec, crc, append = json.loads(line)
+            except ValueError:
+                continue
+            book = self._books.get(title)
+            if book is None or not append:
+                book = self._books[title] = {"tid": tid, "chunks": []}
+            book["chunks"].append((offset, length, size, codec, crc))
+        self._index_pos += end
+
+    def __contains__(self, title):
+        with self._lock:
+            self._refresh()
+            return title in self._books
+
+    def titles(self):
+        with self._lock:
+            self._refresh()
+            return list(self._books)
+
+    def tid(self, title):
+        with self._lock:
+            self._refresh()
+            book = self._books.get(title)
+            return book["tid"] if book else None
+
+    def size(self, title):
+        """书的原始字节数（对应 txt 文件大小）"""
+        with self._lock:
+            self._refresh()
+            book = self._books.get(title)
+            return sum(c[2] for c in book["chunks"]) if book else 0
+
+    def add(self, title, tid, src, append=False, prefix=b""):
+        """把文件 src 的内容（前面加上 prefix）压缩成一块追加；append=False 时替换这本书原有的内容"""
+        tmp = f"{self.path}.{os.getpid()}.{get_ident()}.tmp"
+        comp = pack_compressor(self.codec)
+        crc, size = zlib.crc32(prefix), len(prefix)
+        # 先在锁外压缩到临时文件，锁内只做顺序拷贝，并发写入的节点不会互相等压缩
+        with open(src, "rb") as fin, open(tmp, "wb") as fout:
+            fout.write(comp.compress(prefix))
+            while True:
+                chunk = fin.read(1 << 20)
+                if not chunk:
+                    break
+                crc = zlib.crc32(chunk, crc)
+                size += len(chunk)
+                fout.write(comp.compress(chunk))
+            fout.write(comp.flush())
+        try:
+            with self._file_lock:
+                with open(self.path, "ab") as pack, open(tmp, "rb") as blob:
+                    offset = pack.seek(0, os.SEEK_END)
+                    while True:
+                        chunk = blob.read(1 << 20)
+                        if not chunk:
+                            break
+                        pack.write(chunk)
+                    length = pack.tell() - offset
+                    pack.flush()
+                    os.fsync(pack.fileno())
+                record = [title, tid, offset, length, size, self.codec, crc, append]
+                with open(self.index_path, "ab") as idx:
+                    idx.write(json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n")
+        finally:
+            os.remove(tmp)
+
+    def _view(self, end):
+        """pack 文件的只读映射；别的进程追加后长度不够时重新映射"""
+        if self._map is None or len(self._map) < end:
+            if self._map is not None:
+                self._map.close()
+            with open(self.path, "rb") as f:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map
+
+    def iter_chunks(self, title):
+        """按顺序返回一本书各块解压后的字节，校验 crc"""
+        with self._lock:
+            self._refresh()
+            book = self._books.get(title)
+            if book is None:
+                raise KeyError(title)
+            chunks = list(book["chunks"])
+        for offset, length, size, codec, crc in chunks:
+            with self._lock:
+                data = self._view(offset + length)[offset:offset + length]
+            raw = pack_decompress(codec, data)
+            if len(raw) != size or zlib.crc32(raw) != crc:
+                raise ValueError(f"归档损坏：{title} @ {offset}")
+            yield raw
+
+    def read(self, title):
+        return b"".join(self.iter_chunks(title)).decode("utf-8")
+
+    def export(self, title, dest_dir):
+        """导出成 txt 后端的布局：dest_dir/书名.txt"""
+        path = os.path.join(dest_dir, title + ".txt")
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            for raw in self.iter_chunks(title):
+                f.write(raw)
+        os.replace(tmp, path)
+        return path
+
+
+_archive = None
+_archive_lock = Lock()
+
+
+def get_archive():
+    """OUTPUT_BACKEND 为 pack 时返回进程内共享的归档，否则返回 None"""
+    global _archive
+    if OUTPUT_BACKEND != "pack":
+        return None
+    with _archive_lock:
+        if _archive is None:
+            _archive = PackArchive(PACK_FILE, PACK_INDEX)
+        return _archive
+
+
+def book_exists(title):
+    """这本书是否已有输出（txt 文件或归档中的条目）"""
+    archive = get_archive()
+    if archive is not None:
+        return title in archive
+    return os.path.exists(os.path.join(OUTPUT_DIR, title + ".txt"))
+
+
+def export_archive(dest_dir=OUTPUT_DIR, titles=None):
+    """把归档中的书（默认全部）导出为 dest_dir/书名.txt"""
+    archive = PackArchive(PACK_FILE, PACK_INDEX)
+    os.makedirs(dest_dir, exist_ok=True)
+    titles = archive.titles() if titles is None else titles
+    for title in titles:
+        if title not in archive:
+            print(f"[pack] 归档中没有「{title}」")
+            continue
+        archive.export(title, dest_dir)
+    print(f"[pack] 已导出 {len(titles)} 本到 {dest_dir}/")
+
+
+def import_txt_files():
+    """把 output/ 下现有的 txt 文件打包进归档，校验读回一致后删除原文件（切换到 pack 后端时用）"""
+    archive = PackArchive(PACK_FILE, PACK_INDEX)
+    n = 0
+    for entry in sorted(os.scandir(OUTPUT_DIR), key=lambda e: e.name):
+        if not entry.name.endswith(".txt") or not entry.is_file():
+            continue
+        title = entry.name[:-4]
+        archive.add(title, state_store.tid(title), entry.path)
+        with open(entry.path, "rb") as f:
+            if b"".join(archive.iter_chunks(title)) != f.read():
+                raise ValueError(f"归档读回与原文件不一致：{entry.path}")
+        os.remove(entry.path)
+        n += 1
+    print(f"[pack] 已打包 {n} 本到 {archive.path}")
+
+
+# ---------- EPUB 输出（后台逐章打包） ----------
+# EPUB_OUTPUT 为 True 时，除 txt / 归档之外再生成 output/书名.epub。写出器每写完一章就把清洗好的正文
+# 放进有界队列，由这本书的后台线程转成一个 XHTML 压缩写进 zip；nav.xhtml、toc.ncx、content.opf
+# 在整本完成时写入，再原子改名。内存里只保留各章的目录标题，打包与抓取同时进行，不在最后再读一遍 txt。
+EPUB_CONTAINER = ('<?xml version="1.0" encoding="utf-8"?>\n'
+                  '<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+                  '<rootfiles><rootfile full-path="content.opf" media-type="application/oebps-package+xml"/>'
+                  '</rootfiles></container>\n')
+EPUB_CSS = "body { margin: 0 0.5em; } h1 { font-size: 1.2em; } p { text-indent: 2em; margin: 0.3em 0; }\n"
+EPUB_XHTML_HEAD = ('<?xml version="1.0" encoding="utf-8"?>\n<!DOCTYPE html>\n'
+                   '<html xmlns="http://www.w3.org/1999/xhtml" xml:lang="zh"><head><title>{title}</title>'
+                   '<link rel="stylesheet" type="text/css" href="../style.css"/></head><body>\n')
+EPUB_NAV_RE = re.compile(r'<a href="(text/c\d+\.xhtml)">([^<]*)</a>')
+EPUB_INVALID_RE = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f￾￿]')   # XML 不允许的字符
+
+
+def epub_text(text):
+    return xml_escape(EPUB_INVALID_RE.sub('', text))
+
+
+class EpubWriter:
+    """一本书的 EPUB。add 只是入队（队满时等后台线程），写 zip 全在后台线程里做。
+
+    prior(epub, zf) 在写新章节之前补上已有的章节（复制旧 epub，或从 .part 还原）；
+    lazy=True 时（增量更新）等第一个新章节到了才开始，没有新章节就不动原来的 epub。
+    bounded=False 时（异步引擎，add 在事件循环里调用）队列不设上限，add 从不阻塞。
+    临时文件与 txt 一样按书名固定为 书名.epub.part，上次崩溃留下的会在重新打开时被截断覆盖。
+    """
+
+    def __init__(self, title, tid, prior=None, lazy=False, bounded=True):
+        self.title = title
+        self.tid = tid
+        self.fname = os.path.join(OUTPUT_DIR, title + ".epub")
+        self.tmp = self.fname + ".part"
+        self.toc = []           # [(条目名, 目录标题)]
+        self.error = None
+        self.built = False
+        self._aborted = False
+        self._queue = queue.Queue(maxsize=REORDER_WINDOW if bounded else 0)
+        self._thread = Thread(target=self._run, args=(prior, lazy), name=f"epub-{title}", daemon=True)
+        self._thread.start()
+
+    def add(self, text):
+        self._queue.put(text)
+
+    def _run(self, prior, lazy):
+        try:
+            first = self._queue.get() if lazy else False
+            if first is None:
+                return
+            with zipfile.ZipFile(self.tmp, "w", zipfile.ZIP_DEFLATED, compresslevel=EPUB_LEVEL) as zf:
+                # mimetype 必须是第一个条目且不压缩
+                zf.writestr("mimetype", "application/epub+zip", compress_type=zipfile.ZIP_STORED)
+                zf.writestr("META-INF/container.xml", EPUB_CONTAINER)
+                zf.writestr("style.css", EPUB_CSS)
+                if prior is not None:
+                    prior(self, zf)
+                text = first if first else self._queue.get()
+                while text is not None:
+                    self.chapter(zf, text.split("\n"))
+                    text = self._queue.get()
+                if not self._aborted:
+                    self._finish(zf)
+            self.built = not self._aborted
+        except Exception as e:
+            self.error = e
+            # 出错后继续取走队列里的章节，提交线程不会卡在 add 上
+            while self._queue.get() is not None:
+                pass
+
+    def chapter(self, zf, lines, label=None):
+        """写一章：lines 可以是任意行迭代器（还原大段旧文时不必整段读进内存）；默认用首行作目录标题"""
+        lines = iter(lines)
+        head = []
+        for line in lines:
+            line = line.strip()
+            if line:
+                head.append(line)
+                break
+        n = len(self.toc) + 1
+        if label is None:
+            label = head[0] if head and len(head[0]) <= EPUB_TITLE_CHARS else f"{self.title}（{n}）"
+        name = f"text/c{n:05d}.xhtml"
+        with metrics.timer("stage_seconds", stage="epub"):
+            with io.TextIOWrapper(zf.open(name, "w"), encoding="utf-8", newline="\n") as f:
+                f.write(EPUB_XHTML_HEAD.format(title=epub_text(label)))
+                for line in head:
+                    f.write(f"<p>{epub_text(line)}</p>\n")
+                for line in lines:
+                    line = line.strip()
+                    if line:
+                        f.write(f"<p>{epub_text(line)}</p>\n")
+                f.write("</body></html>\n")
+        self.toc.append((name, label))
+
+    def _finish(self, zf):
+        title = epub_text(self.title)
+        items = "".join(f'<item id="c{i + 1:05d}" href="{name}" media-type="application/xhtml+xml"/>\n'
+                        for i, (name, _) in enumerate(self.toc))
+        spine = "".join(f'<itemref idref="c{i + 1:05d}"/>\n' for i in range(len(self.toc)))
+        zf.writestr("content.opf", (
+            '<?xml version="1.0" encoding="utf-8"?>\n'
+            '<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="bookid" xml:lang="zh">\n'
+            '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">\n'
+            f'<dc:identifier id="bookid">urn:cool18:tid:{self.tid}</dc:identifier>\n'
+            f'<dc:title>{title}</dc:title>\n<dc:language>zh</dc:language>\n'
+            f'<meta property="dcterms:modified">{time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())}</meta>\n'
+            '</metadata>\n<manifest>\n'
+            '<item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>\n'
+            '<item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>\n'
+            '<item id="css" href="style.css" media-type="text/css"/>\n'
+            f'{items}</manifest>\n<spine toc="ncx">\n{spine}</spine>\n</package>\n'))
+        links = "".join(f'<li><a href="{name}">{epub_text(label)}</a></li>\n' for name, label in self.toc)
+        zf.writestr("nav.xhtml", (
+            '<?xml version="1.0" encoding="utf-8"?>\n<!DOCTYPE html>\n'
+            '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" xml:lang="zh">'
+            f'<head><title>{title}</title></head><body>\n'
+            f'<nav epub:type="toc" id="toc"><h1>{title}</h1><ol>\n{links}</ol></nav>\n</body></html>\n'))
+        points = "".join(f'<navPoint id="p{i + 1}" playOrder="{i + 1}"><navLabel><text>{epub_text(label)}</text>'
+                         f'</navLabel><content src="{name}"/></navPoint>\n' for i, (name, label) in enumerate(self.toc))
+        zf.writestr("toc.ncx", (
+            '<?xml version="1.0" encoding="utf-8"?>\n'
+            '<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">'
+            f'<head><meta name="dtb:uid" content="urn:cool18:tid:{self.tid}"/></head>\n'
+            f'<docTitle><text>{title}</text></docTitle>\n<navMap>\n{points}</navMap>\n</ncx>\n'))
+
+    def close(self):
+        """所有章节已提交：等后台线程写完目录，替换正式的 .epub"""
+        self._queue.put(None)
+        self._thread.join()
+        if self.error is not None:
+            with print_lock:
+                print(f"    [epub] {self.title} 打包失败：{self.error}")
+        elif self.built:
+            os.replace(self.tmp, self.fname)
+            return
+        self._remove_tmp()
+
+    def abort(self):
+        self._aborted = True
+        self._queue.put(None)
+        self._thread.join()
+        self._remove_tmp()
+
+    def _remove_tmp(self):
+        try:
+            os.remove(self.tmp)
+        except OSError:
+            pass
+
+
+def iter_lines(chunks):
+    """把 UTF-8 字节块逐行解码，不把整段读进内存"""
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    rest = ""
+    for chunk in chunks:
+        lines = (rest + decoder.decode(chunk)).split("\n")
+        rest = lines.pop()
+        yield from lines
+    yield rest + decoder.decode(b"", final=True)
+
+
+def read_chunks(f, size, chunk=1 << 16):
+    while size > 0:
+        data = f.read(min(chunk, size))
+        if not data:
+            break
+        size -= len(data)
+        yield data
+
+
+def epub_copy(path):
+    """增量更新：按旧 epub 的目录逐个复制章节条目（解压后重新压缩，一次一章）"""
+    def prior(epub, zf):
+        with zipfile.ZipFile(path) as src:
+            for name, label in EPUB_NAV_RE.findall(src.read("nav.xhtml").decode("utf-8")):
+                with src.open(name) as s, zf.open(name, "w") as d:
+                    shutil.copyfileobj(s, d, 1 << 16)
+                epub.toc.append((name, xml_unescape(label)))
+    return prior
+
+
+def epub_from_text(title):
+    """增量更新但还没有 epub（刚打开 EPUB_OUTPUT 或 1.0 版下载的书）：原有正文分不出章节，整体作为一节"""
+    def prior(epub, zf):
+        archive = get_archive()
+        if archive is not None:
+            if title in archive:
+                epub.chapter(zf, iter_lines(archive.iter_chunks(title)), label="此前的章节")
+            return
+        with open(os.path.join(OUTPUT_DIR, title + ".txt"), "r", encoding="utf-8") as f:
+            epub.chapter(zf, f, label="此前的章节")
+    return prior
+
+
+def epub_from_part(path, size, ends):
+    """断点续抓：按断点记下的每章结束位置，把 .part 里已写入的章节补进 epub（没有记录时整体作为一节）"""
+    def prior(epub, zf):
+        with open(path, "rb") as f:
+            if not ends:
+                epub.chapter(zf, iter_lines(read_chunks(f, size)), label="此前的章节")
+                return
+            start = 0
+            for end in ends:
+                text = f.read(end - start).decode("utf-8")
+                if start:
+                    text = text[len(os.linesep):]   # 章节之间的换行
+                epub.chapter(zf, text.replace(os.linesep, "\n").split("\n"))
+                start = end
+    return prior
+
+
+def open_epub(title, tid, append=False, cp=None, bounded=True):
+    """EPUB_OUTPUT 为 True 时创建这本书的 EpubWriter，否则返回 None"""
+    if not EPUB_OUTPUT:
+        return None
+    if append:
+        path = os.path.join(OUTPUT_DIR, title + ".epub")
+        prior = epub_copy(path) if os.path.exists(path) else epub_from_text(title)
+        return EpubWriter(title, tid, prior, lazy=True, bounded=bounded)
+    if cp is not None:
+        part = os.path.join(OUTPUT_DIR, title + ".txt.part")
+        return EpubWriter(title, tid, epub_from_part(part, cp["part_size"], cp.get("ends")), bounded=bounded)
+    return EpubWriter(title, tid, bounded=bounded)
+
+
+# ---------- 流式写出（按章节序号重排） ----------
+class BookWriter:
+    """按章节序号重排的写出器：前序章节到齐即清洗并写入临时文件，整本完成后原子改名。
+
+    序号超出重排窗口的章节会阻塞提交线程，因此内存占用与书的长度无关。
+    append=True 时新章节先写临时文件，完成后再追加到原文件末尾。
+    checkpoint 不为 None 时每写出一章保存断点；resume=(字节数, 章数) 时截断并续写已有的临时文件。
+    dedup 不为 None 时按写出顺序去重，重复的章节在清洗之前跳过。
+    epub 不为 None 时每写出一章同时交给它在后台打包。
+    """
+
+    def __init__(self, title, inner_titles, append=False, window=REORDER_WINDOW, checkpoint=None, resume=None,
+                 dedup=None, epub=None):
+        self.title = title
+        self.dedup = dedup
+        self.epub = epub
+        self.inner_titles = tuple(inner_titles)
+        self.clean = make_cleaner(self.inner_titles)
+        self.append = append
+        self.window = window
+        self.checkpoint = checkpoint
+        self.resumed = resume is not None
+        self.fname = os.path.join(OUTPUT_DIR, title + ".txt")
+        self.tmp = self.fname + ".part"
+        self.written = 0  # 已写出的非空章节数
+        if resume is None:
+            self._f = open(self.tmp, "w", encoding="utf-8")
+        else:
+            # 断点之后可能还有写了一半的章节，截掉后接着写
+            size, self.written = resume
+            self._f = open(self.tmp, "r+", encoding="utf-8")
+            self._f.truncate(size)
+            self._f.seek(0, os.SEEK_END)
+        self._next = 0
+        self._pending = {}
+        self._cond = Condition()
+
+    def put(self, index, text, cleaned=None, tid=None):
+        """提交第 index 章（text 为空表示该章缺失）；cleaned 为已清洗好的正文时不再重复清洗。
+        tid 为该章的帖子 tid（首页不传），用于断点与去重"""
+        # 指纹在提交线程里算好，写出时只做比较
+        fp = fingerprint(text) if self.dedup is not None and text else None
+        with self._cond:
+            while index >= self._next + self.window:
+                self._cond.wait()
+            self._pending[index] = (text, cleaned, tid, fp)
+            while self._next in self._pending:
+                self._write(self._pending.pop(self._next))
+                self._next += 1
+            self._cond.notify_all()
+
+    def _write(self, item):
+        text, cleaned, tid, fp = item
+        if not text:
+            return
+        if fp is not None:
+            dup = self.dedup.check(tid, fp)
+            if dup is not None:
+                with print_lock:
+                    print(f"    [dedup] tid={tid or self.dedup.start_tid} 与 tid={dup} 内容重复，跳过")
+                return
+        if cleaned is None:
+            cleaned = self.clean(text)
+        if cleaned:
+            with metrics.timer("stage_seconds", stage="write"):
+                self._f.write(('\n' if self.written else '') + cleaned)
+                self.written += 1
+                if self.checkpoint is not None:
+                    # 先让 .part 落到文件系统再记断点，断点记录的长度不会超过实际内容
+                    self._f.flush()
+                    self.checkpoint.save(tid, os.fstat(self._f.fileno()).st_size, self.written)
+            if self.epub is not None:
+                self.epub.add(cleaned)
+            metrics.inc("book_chapters_total", book=self.title)
+
+    def close(self):
+        """全部章节提交完毕：写完剩余章节并替换 / 追加到正式文件"""
+        with self._cond:
+            for index in sorted(self._pending):
+                self._write(self._pending.pop(index))
+        if self.epub is not None:
+            # 先等 epub 写完：增量更新时它可能还在读原来的 txt
+            self.epub.close()
+        with metrics.timer("stage_seconds", stage="write"):
+            self._finish()
+
+    def _finish(self):
+        """关闭临时文件，替换或追加到正式文件（pack 后端时压缩进归档）"""
+        self._f.close()
+        archive = get_archive()
+        if archive is not None:
+            # 归档自己用文件锁串行追加，压缩在锁外进行；这里不再占用进程级的 file_lock，别的书保存时不必等这本书压缩
+            self._finish_pack(archive)
+        else:
+            with file_lock:
+                self._finish_txt()
+        with print_lock:
+            if not self.append:
+                print(f"【saved】{self.where(archive)}\n")
+            elif self.written:
+                print(f"【updated】{self.where(archive)}  新增 {self.written} 章\n")
+            else:
+                print(f"    {self.title} 无新章节")
+
+    def _finish_pack(self, archive):
+        if not self.append:
+            archive.add(self.title, state_store.tid(self.title), self.tmp)
+        elif self.written:
+            # 与 txt 后端以文本方式追加的换行一致
+            sep = os.linesep.encode() if archive.size(self.title) > 0 else b''
+            archive.add(self.title, state_store.tid(self.title), self.tmp, append=True, prefix=sep)
+        os.remove(self.tmp)
+        if not self.append and self.checkpoint is not None:
+            self.checkpoint.remove()
+
+    def _finish_txt(self):
+        if not self.append:
+            os.replace(self.tmp, self.fname)
+            if self.checkpoint is not None:
+                self.checkpoint.remove()
+            return
+        if self.written:
+            sep = '\n' if os.path.getsize(self.fname) > 0 else ''
+            with open(self.tmp, "r", encoding="utf-8") as src, open(self.fname, "a", encoding="utf-8") as dst:
+                dst.write(sep)
+                while True:
+                    chunk = src.read(1 << 16)
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+        os.remove(self.tmp)
+
+    def where(self, archive):
+        return self.fname if archive is None else f"{archive.path} / {self.title}"
+
+    def abort(self):
+        """抓取异常：丢弃临时文件，正式文件保持不变；已有断点时保留临时文件，下次续抓"""
+        self._f.close()
+        if self.epub is not None:
+            self.epub.abort()
+        if self.checkpoint is not None and self.written:
+            return
+        try:
+            os.remove(self.tmp)
+        except OSError:
+            pass
+
+
+# ---------- 解析进程池（正文提取与清洗） ----------
+_cleaners = {}
+
+
+def parse_page(html, inner_titles):
+    """html 为页面字节（或 str），返回 (标题前缀, 正文, 清洗后的正文)；线程内与子进程内走同一个函数"""
+    cleaner = _cleaners.get(inner_titles)
+    if cleaner is None:
+        if len(_cleaners) > 64:
+            _cleaners.clear()
+        cleaner = _cleaners[inner_titles] = make_cleaner(inner_titles)
+    text = extract_text(html)
+    return extract_title(html), text, cleaner(text) if text else ""
+
+
+def parse_batch(items):
+    """子进程入口：一次处理多页 [(html, 内链标题)]"""
+    return [parse_page(html, titles) for html, titles in items]
+
+
+PARSE_CHILD_LOADER = """
+import sys, importlib.util
+spec = importlib.util.spec_from_file_location({name!r}, {path!r})
+module = sys.modules[{name!r}] = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+"""
+
+
+class ParsePool:
+    """把页面解析交给进程池，绕开 GIL。
+
+    提交的页面先进队列，由分发线程把积压的页面（最多 batch 个）合并成一个任务发给子进程；
+    空闲时来一页发一页，不额外等待。同一本书的内链标题是同一个 tuple，pickle 时每批只序列化一次。
+    """
+
+    def __init__(self, processes, batch=PARSE_BATCH):
+        self.batch = batch
+        # 用 spawn 启动子进程：此时抓取、调度、SQLite 写入、指标等线程都在运行，fork 可能把别的线程
+        # 正持有的锁（如 metrics._lock）原样带进子进程，子进程一计时就永远卡住
+        initializer, initargs = None, ()
+        if __name__ != "__main__":
+            # 被 importlib 按路径加载（基准测试等）时，子进程按不了模块名导入本脚本，先照样加载一次
+            initializer, initargs = exec, (PARSE_CHILD_LOADER.format(name=__name__, path=os.path.abspath(__file__)),)
+        self._executor = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn"),
+                                             initializer=initializer, initargs=initargs)
+        self._queue = queue.Queue()
+        self._dispatcher = Thread(target=self._dispatch, name="parse-dispatch", daemon=True)
+        self._dispatcher.start()
+
+    def submit(self, html, inner_titles=()):
+        future = Future()
+        self._queue.put((future, html, inner_titles))
+        return future
+
+    def _dispatch(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            items = [item]
+            while len(items) < self.batch:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)
+                    break
+                items.append(item)
+            try:
+                task = self._executor.submit(parse_batch, [(html, titles) for _, html, titles in items])
+            except Exception as e:
+                for future, _, _ in items:
+                    future.set_exception(e)
+                continue
+            task.add_done_callback(lambda task, items=items: self._resolve(task, items))
+
+    @staticmethod
+    def _resolve(task, items):
+        try:
+            results = task.result()
+        except Exception as e:
+            for future, _, _ in items:
+                future.set_exception(e)
+            return
+        for (future, _, _), result in zip(items, results):
+            future.set_result(result)
+
+    def shutdown(self):
+        self._queue.put(None)
+        self._dispatcher.join()
+        self._executor.shutdown()
+
+
+_parse_pool = None
+_parse_pool_lock = Lock()
+
+
+def parse(html, inner_titles=()):
+    """解析页面：PARSE_PROCESSES > 0 时在子进程中进行，否则就在当前线程"""
+    global _parse_pool
+    if PARSE_PROCESSES <= 0:
+        return parse_page(html, inner_titles)
+    with _parse_pool_lock:
+        if _parse_pool is None:
+            _parse_pool = ParsePool(PARSE_PROCESSES)
+        pool = _parse_pool
+    # 子进程里的 extract / clean 计时留在子进程，这里记录从提交到拿到结果的总时间
+    with metrics.timer("stage_seconds", stage="parse_pool"):
+        try:
+            return pool.submit(html, inner_titles).result(timeout=PARSE_TIMEOUT)
+        except (FutureTimeoutError, BrokenProcessPool) as e:
+            metrics.inc("parse_pool_fallback_total")
+            with print_lock:
+                print(f"    [parse] 解析进程池无响应（{type(e).__name__}），改在当前线程解析")
+    return parse_page(html, inner_titles)
+
+
+def reset_parse_pool():
+    """进程数调整后关闭旧进程池，下次使用时重建"""
+    global _parse_pool
+    with _parse_pool_lock:
+        old, _parse_pool = _parse_pool, None
+    if old is not None:
+        old.shutdown()
+
+
+# ---------- 章节级调度器 ----------
+class ChapterScheduler:
+    """全局调度器：工作单元是「某本书的一次页面抓取」，空闲线程可以取任何在抓的书的任务。
+
+    shortest：优先处理未完成任务最少的书，尽快凑齐整本；fifo：按书开始的先后处理。
+    同一本书内部始终按提交顺序取任务，保证写出器等待的前序章节已经在抓。
+    """
+
+    def __init__(self, workers, policy=SCHEDULER_POLICY):
+        self.policy = policy
+        self._queues = {}       # 书 -> 待执行任务
+        self._outstanding = {}  # 书 -> 排队中 + 执行中的任务数
+        self._order = {}        # 书 -> 开始顺序
+        self._counter = 0
+        self._cond = Condition()
+        self._shutdown = False
+        self._threads = [Thread(target=self._run, name=f"fetch-{i}", daemon=True) for i in range(workers)]
+        for t in self._threads:
+            t.start()
+
+    def submit(self, book, fn, *args):
+        future = Future()
+        with self._cond:
+            if book not in self._queues:
+                self._queues[book] = deque()
+                self._outstanding[book] = 0
+            if book not in self._order:
+                self._order[book] = self._counter
+                self._counter += 1
+            self._queues[book].append((future, fn, args))
+            self._outstanding[book] += 1
+            self._cond.notify()
+        return future
+
+    def release(self, book):
+        """书已完成，不再参与排序"""
+        with self._cond:
+            self._order.pop(book, None)
+
+    def _take(self):
+        ready = [b for b, q in self._queues.items() if q]
+        if not ready:
+            return None
+        if self.policy == "fifo":
+            book = min(ready, key=lambda b: self._order.get(b, 0))
+        else:
+            book = min(ready, key=lambda b: (self._outstanding[b], self._order.get(b, 0)))
+        return book, self._queues[book].popleft()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                item = self._take()
+                while item is None:
+                    if self._shutdown:
+                        return
+                    self._cond.wait()
+                    item = self._take()
+            book, (future, fn, args) = item
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn(*args))
+                except BaseException as e:
+                    future.set_exception(e)
+            with self._cond:
+                self._outstanding[book] -= 1
+                if not self._outstanding[book] and not self._queues[book]:
+                    del self._outstanding[book], self._queues[book]
+                self._cond.notify_all()
+
+    def wait_idle(self):
+        """等待所有已提交的任务完成"""
+        with self._cond:
+            while self._outstanding:
+                self._cond.wait()
+
+    def shutdown(self):
+        with self._cond:
+            self._shutdown = True
+            self._cond.notify_all()
+        for t in self._threads:
+            t.join()
+
+
+_scheduler = None
+_scheduler_lock = Lock()
+
+
+def get_scheduler():
+    """进程内共享的章节调度器，首次使用时创建（线程数为并发上限，实际在途请求数由 concurrency 控制）"""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = ChapterScheduler(MAX_CONCURRENCY if AUTO_TUNE else MAX_WORKERS)
+        return _scheduler
+
+
+def reset_scheduler():
+    """线程数调整后，空闲时关闭旧调度器，下次使用时重建"""
+    global _scheduler
+    with _scheduler_lock:
+        old, _scheduler = _scheduler, None
+    if old is not None:
+        old.wait_idle()
+        old.shutdown()
+
+
+class BookTask:
+    """一本书在调度器中的进度：未完成的抓取任务归零且不再追加时，由最后完成的线程收尾写盘"""
+
+    def __init__(self, title, writer, manifest, on_done=None):
+        self.title = title
+        self.writer = writer
+        self.manifest = manifest
+        self.on_done = on_done
+        self.done = Event()
+        self._pending = 0
+        self._sealed = False
+        self._finished = False
+        self._lock = Lock()
+
+    def submit(self, fn, *args):
+        with self._lock:
+            self._pending += 1
+        future = get_scheduler().submit(self.title, fn, *args)
+        # 完成或被取消时都会回调，回调在完成该任务的工作线程里执行
+        future.add_done_callback(self._task_done)
+        return future
+
+    def record(self, tid):
+        with self._lock:
+            record_chapter(self.manifest, tid)
+
+    def miss(self, tid):
+        with self._lock:
+            record_missing(self.manifest, tid)
+
+    def _task_done(self, _future):
+        with self._lock:
+            self._pending -= 1
+            last = self._sealed and not self._pending and not self._finished
+            self._finished = self._finished or last
+        if last:
+            self._complete()
+
+    def seal(self):
+        """本书不会再提交新任务"""
+        with self._lock:
+            self._sealed = True
+            last = not self._pending and not self._finished
+            self._finished = self._finished or last
+        if last:
+            self._complete()
+
+    def _complete(self):
+        ok = False
+        try:
+            self.writer.close()
+            save_manifest(self.manifest)
+            ok = True
+        except Exception as e:
+            with print_lock:
+                print(f"[error] 保存 {self.title} 失败: {e}")
+        finally:
+            self._release(ok)
+
+    def abort(self):
+        with self._lock:
+            self._finished = True
+        self.writer.abort()
+        self._release(False)
+
+    def _release(self, ok):
+        get_scheduler().release(self.title)
+        self.done.set()
+        if self.on_done:
+            self.on_done(ok)
+
+
+# ---------- 多线程抓取函数 ----------
+def fetch_page(url, inner_titles=()):
+    """获取单个页面，返回 (url, 标题前缀, 正文, 清洗后的正文)；下载失败时后三项为 None"""
+    body = get_body(url)
+    if body:
+        return (url,) + parse(body, inner_titles)
+    return url, None, None, None
+
+
+def probe_page(url, base_prefix):
+    """tid 探测：标题前缀不一致的页面只读到 </title> 为止；返回值比 fetch_page 多一项截断时读到的前缀"""
+    body, prefix = fetch_body(url, base_prefix=base_prefix)
+    if body:
+        return (url,) + parse(body) + (prefix,)
+    return url, None, None, None, prefix
+
+
+def fetch_chapter(book, index, url):
+    """抓取一个内链章节并按序号交给写出器（在调度器线程中执行）"""
+    dedup = book.writer.dedup
+    if dedup is not None and dedup.known_dup(tid_of(url)):
+        book.writer.put(index, None)
+        book.record(tid_of(url))
+        return
+    title = text_content = cleaned = None
+    try:
+        url, title, text_content, cleaned = fetch_page(url, book.writer.inner_titles)
+    finally:
+        if title is None:
+            # 先记缺章再交给写出器：写出后面的章节时保存的断点要带上它
+            book.miss(tid_of(url))
+        # 无论成败都要占住这个序号，否则后面的章节会一直等
+        book.writer.put(index, text_content, cleaned, tid_of(url))
+    if title is not None:
+        book.record(tid_of(url))
+
+
+def crawl_one_threaded(info, manifest=None, on_done=None):
+    """多线程优化的单本小说抓取；传入清单时只抓清单之后的新章节并追加到原文件。
+
+    所有页面抓取都交给全局章节调度器。内链书提交完章节任务即返回，最后一章落地时自动保存；
+    返回 BookTask（可 .done.wait() 等待），首页失败时返回 None。无论成败最终都会调用 on_done(ok)。
+    """
+    title, first_url, start_tid = info["title"], info["url"], info["tid"]
+    incremental = manifest is not None
+    with print_lock:
+        if incremental:
+            print(f"【check】{title}  （上次抓到 tid={manifest['last_tid']}）")
+        else:
+            print(f"【start】{title}  （首tid={start_tid}）")
+    
+    # 增量检查时首页必须重新验证，才能发现新增的内链
+    html = get_scheduler().submit(title, get_html, first_url, 0 if incremental else None).result()
+    if not html:
+        with print_lock:
+            print(f"[fail] 首页下载失败 {first_url}")
+        if on_done:
+            on_done(False)
+        return None
+    
+    base_prefix = extract_title(html)
+    inner_links = find_inner_links(html, first_url)
+    inner_titles = [txt for _, txt in inner_links]
+    writer, manifest = open_writer(info, manifest, inner_titles)
+    book = BookTask(title, writer, manifest, on_done)
+    try:
+        crawl_chapters_threaded(book, html, inner_links, base_prefix)
+    except BaseException:
+        book.abort()
+        raise
+    book.seal()
+    return book
+
+
+def crawl_chapters_threaded(book, html, inner_links, base_prefix):
+    """提交首页之后的章节任务，按源码顺序交给写出器"""
+    writer, manifest = book.writer, book.manifest
+    # 增量更新与断点续抓都不再写首页
+    incremental = writer.append or writer.resumed
+    seq = 0
+    if not incremental:
+        writer.put(seq, extract_text(html))
+        seq += 1
+
+    # ---------- 内链处理（并行） ----------
+    if inner_links:
+        manifest["mode"] = "inner"
+        done = skipped_tids(manifest)
+        urls = [url for url, _ in reversed(inner_links) if tid_of(url) not in done]
+        if urls:
+            with print_lock:
+                print(f"    发现 {len(urls)} 个{'新' if incremental else ''}内链章节，并行抓取...")
+
+            # 章节任务进入全局调度器，写出器负责按源码顺序落盘
+            for i, url in enumerate(urls):
+                book.submit(fetch_chapter, book, seq + i, url)
+
+    # ---------- tid 递增（自适应投机窗口） ----------
+    else:
+        manifest["mode"] = "tid"
+        with print_lock:
+            print("    无内链，启用并行 tid 递增。")
+        probe_tids_threaded(book, seq, base_prefix)
+
 
-# 配置常量
-MAX_PAGES = 38
-MIN_DELAY = 0.2  # 多线程版本的延迟
-MAX_DELAY = 0.5
-MAX_WORKERS = 8  # 线程池大小
+def probe_tids_threaded(book, seq, base_prefix):
+    """按 tid 顺序逐个判定前缀，窗口内的后续 tid 提前并行抓取；结束条件确定后取消未开始的请求"""
+    writer, manifest = book.writer, book.manifest
+    next_check = next_submit = manifest["last_tid"] + 1
+    window = PROBE_WINDOW_MIN
+    fail_streak = 0
+    inflight = {}
+    dups = set()
+    known = KnownTids(tid_index)
+    stats = {"requests": 0, "chapters": 0, "cut": 0, "indexed": 0}
 
-OUTPUT_DIR = "output"
-LIST_DIR = "list"
-os.makedirs(OUTPUT_DIR, exist_ok=True)
-os.makedirs(LIST_DIR, exist_ok=True)
+    while fail_streak < 3:
+        while next_submit < next_check + window:
+            # 上次判为重复的本书章节、索引里已知属于别的书的 tid 都不再联网
+            if writer.dedup is not None and writer.dedup.known_dup(next_submit):
+                dups.add(next_submit)
+            elif known.foreign_prefix(next_submit, base_prefix) is None:
+                inflight[next_submit] = book.submit(probe_page, f"{BASE_URL}{next_submit}", base_prefix)
+            next_submit += 1
+        future = inflight.pop(next_check, None)
+        if next_check in dups:
+            title, text_content, cleaned = base_prefix, None, None
+        elif future is None:
+            title = text_content = cleaned = None
+            stats["indexed"] += 1
+        else:
+            _, title, text_content, cleaned, cut_prefix = future.result()
+            stats["requests"] += 1
+            stats["cut"] += cut_prefix is not None
+        manifest["probed_tid"] = max(manifest["probed_tid"], next_check)
 
-MAIN_LIST = os.path.join(LIST_DIR, "main.list")
-TEMP_LIST = os.path.join(LIST_DIR, "temp.list")
+        if title is not None and title == base_prefix:
+            if fail_streak > 0:
+                with print_lock:
+                    print(f"    tid={next_check}  前缀恢复一致")
+            fail_streak = 0
+            book.record(next_check)
+            if text_content:
+                writer.put(seq, text_content, cleaned, next_check)
+                seq += 1
+                stats["chapters"] += 1
+        else:
+            fail_streak += 1
+        window = next_probe_window(window, fail_streak)
+        next_check += 1
 
-# 线程锁
-file_lock = Lock()
-print_lock = Lock()
+    # 连续 3 次失败已确定：还没开始的投机请求直接取消，已完成的计入浪费
+    for future in inflight.values():
+        if not future.cancel():
+            stats["requests"] += 1
+            stats["cut"] += future.result()[4] is not None
 
+    log_probe_stats(book.title, stats, base_prefix, next_check - 1)
 
-# ---------- 优化的网络请求 ----------
-# 创建一个全局session，复用连接
-session = requests.Session()
-session.headers.update(HEADERS)
-# 设置连接池参数
-adapter = requests.adapters.HTTPAdapter(
-    pool_connections=20,
-    pool_maxsize=20,
-    max_retries=RETRY
-)
-session.mount('http://', adapter)
-session.mount('https://', adapter)
-
-
-def get_html(url):
-    """线程安全的HTML获取函数"""
-    for attempt in range(RETRY):
-        try:
-            r = session.get(url, timeout=TIMEOUT)
-            r.raise_for_status()
-            r.encoding = "utf-8"
-            return r.text
-        except requests.exceptions.RequestException as e:
+
+def next_probe_window(window, fail_streak):
+    """前缀连续一致时窗口翻倍，出现不一致时减半"""
+    if fail_streak == 0:
+        return min(PROBE_WINDOW_MAX, window * 2)
+    return max(PROBE_WINDOW_MIN, window // 2)
+
+
+def log_probe_stats(title, stats, base_prefix, last_tid):
+    chapters = stats["chapters"]
+    metrics.inc("probe_requests_total", stats["requests"])
+    metrics.inc("probe_cut_total", stats["cut"])
+    metrics.inc("probe_indexed_total", stats["indexed"])
+    # 没有得到章节的探测请求都算浪费（别的帖子、不存在的 tid、结束后多发的投机请求）
+    metrics.inc("probe_wasted_total", stats["requests"] - chapters)
+    metrics.inc("book_probe_requests_total", stats["requests"], book=title)
+    per = f"{stats['requests'] / chapters:.2f}" if chapters else "-"
+    later = tid_index.next_with_prefix(base_prefix, last_tid)
+    with print_lock:
+        print(f"    tid 探测结束：请求 {stats['requests']} 次（{stats['cut']} 次只读页头），"
+              f"索引跳过 {stats['indexed']} 次，得到 {chapters} 章，每章 {per} 次请求")
+        if later is not None:
+            print(f"    [提示] 索引中 tid={later} 仍是「{base_prefix}」，可能在容错范围之外还有章节")
+
+
+def plan_page(novels):
+    """把一页小说分成「新书」和「已有清单、待检查新章节」两组；没有清单的旧文件保持跳过"""
+    to_download, to_update = [], []
+    for info in novels:
+        if book_exists(info["title"]):
+            if state_store.status(info["title"]) != "done":
+                # 状态库里没有记录的已有文件（旧版本下载或手动放入）补记为已完成
+                state_store.mark(info["title"], "done", info["tid"])
+            manifest = load_manifest(info["title"])
+            rebuilds = manifest.get("rebuilds", 0) if manifest is not None else 0
+            if manifest is not None and manifest.get("missing") and rebuilds < MISSING_REBUILDS:
+                # 上次有章节没下载到，缺口在书中间：整本按顺序重抓并替换（已抓过的页面多半命中磁盘缓存）。
+                # 重抓次数记在新清单里，一直下载不到的章节不会让这本书每次都重抓
+                with print_lock:
+                    print(f"    [rebuild] {info['title']} 上次缺 {len(manifest['missing'])} 章，"
+                          f"整本重抓（第 {rebuilds + 1}/{MISSING_REBUILDS} 次）")
+                to_download.append(dict(info, rebuilds=rebuilds + 1))
+            elif manifest is not None:
+                # 缺章重抓次数用完后照常检查新章节，缺的章节留在 missing 里不再抓
+                to_update.append((info, manifest))
+            continue
+        to_download.append(info)
+    return to_download, to_update
+
+
+# ---------- 主函数 ----------
+def scan_index_pages(jobs, n_workers):
+    """生产者：提前抓取并解析目录页，把要处理的书放进有界队列；某页没有书即停止翻页"""
+    seen = set()
+    try:
+        for p in range(1, MAX_PAGES + 1):
+            html = get_html(INDEX_BASE.format(p))
+            if not html:
+                with print_lock:
+                    print(f"第{p}页下载失败，跳过")
+                continue
+
+            novels = list_novels_one_page(html)
+            if not novels:
+                with print_lock:
+                    print(f"第{p}页无新书，结束翻页")
+                break
+
+            # 翻页期间列表可能滚动，同一本书只入队一次
+            novels = [info for info in novels if info["title"] not in seen]
+            seen.update(info["title"] for info in novels)
+            to_download, to_update = plan_page(novels)
+            with print_lock:
+                print(f"\n------ 第{p}页 共{len(novels)} 本：新书 {len(to_download)} 本，检查更新 {len(to_update)} 本 ------")
+            for job in [(info, None) for info in to_download] + to_update:
+                jobs.put(job)
+    except Exception as e:
+        with print_lock:
+            print(f"[error] 扫描目录页失败: {e}")
+    finally:
+        for _ in range(n_workers):
+            jobs.put(None)
+
+
+def start_book(info, manifest, open_books, finished=None):
+    """开抓一本书并登记状态。调用前已占用 open_books 的一个名额，整本结束时归还并调用 finished(ok)"""
+    if manifest is None:
+        state_store.mark(info["title"], "downloading", info["tid"])
+    called = []
+
+    def on_done(ok, is_new=manifest is None):
+        called.append(ok)
+        if is_new or ok:
+            state_store.mark(info["title"], "done" if ok else "failed")
+        open_books.release()
+        if finished:
+            finished(ok)
+
+    try:
+        crawl_one_threaded(info, manifest, on_done=on_done)
+    except Exception as e:
+        with print_lock:
+            print(f"[error] 下载 {info['title']} 失败: {e}")
+        if not called:
+            on_done(False)
+
+
+def book_worker(jobs, open_books, finished=None):
+    """消费者：持续从队列取书开抓，直到收到结束标记。
+
+    内链书提交完章节任务就去取下一本，同时在抓的书数受 open_books 限制。
+    finished 不为 None 时每本书结束后调用 finished(info, ok)。
+    """
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        open_books.acquire()
+        info, manifest = job
+        start_book(info, manifest, open_books,
+                   None if finished is None else lambda ok, info=info: finished(info, ok))
+
+
+def plan_backfill():
+    """补全的书目：状态库中还没有输出文件的书（中断、失败、从旧列表导入但从未下载），最新加入的在前。
+
+    首 tid 取自状态库；没有记录 tid 的（旧列表导入的书）先翻目录页，用 list_novels_one_page 补上。
+    """
+    titles = [t for t in state_store.titles(None) if not book_exists(t)]
+    missing = {t for t in titles if state_store.tid(t) is None}
+    if missing:
+        print(f"[backfill] {len(missing)} 本没有记录首 tid，翻目录页查找...")
+        for p in range(1, MAX_PAGES + 1):
+            html = get_html(INDEX_BASE.format(p))
+            if not html:
+                continue
+            novels = list_novels_one_page(html)
+            if not novels:
+                break
+            for info in novels:
+                if info["title"] in missing:
+                    state_store.mark(info["title"], state_store.status(info["title"]), info["tid"])
+                    missing.discard(info["title"])
+            if not missing:
+                break
+        if missing:
+            print(f"[backfill] {len(missing)} 本在目录页中找不到，跳过")
+    plan = []
+    for title in titles:
+        tid = state_store.tid(title)
+        if tid is not None:
+            plan.append({"title": title, "url": f"{BASE_URL}{tid}", "tid": tid})
+    print(f"[backfill] 待补全 {len(plan)} 本")
+    return plan
+
+
+def queue_backfill(jobs, n_workers):
+    """生产者：待补全的书依次入队，都按新书抓取（有断点的从断点续抓）"""
+    try:
+        for info in plan_backfill():
+            jobs.put((info, None))
+    except Exception as e:
+        with print_lock:
+            print(f"[error] 生成补全书目失败: {e}")
+    finally:
+        for _ in range(n_workers):
+            jobs.put(None)
+
+
+def run_book_pipeline(produce, name, finished=None):
+    """生产者线程把书放进有界队列，多个消费者并行开抓；全部结束后落盘状态库并打印统计"""
+    n_workers = max(1, MAX_WORKERS // 2)
+    jobs = queue.Queue(maxsize=BOOK_QUEUE_SIZE)
+    open_books = Semaphore(MAX_OPEN_BOOKS)
+    producer = Thread(target=produce, args=(jobs, n_workers), name=name)
+    workers = [Thread(target=book_worker, args=(jobs, open_books, finished), name=f"book-{i}")
+               for i in range(n_workers)]
+    producer.start()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    producer.join()
+    # 内链书的最后几章可能还在调度器里
+    get_scheduler().wait_idle()
+
+    merge_lists()
+    http_cache.report()
+    report_metrics()
+    tid_index.flush()
+    dedup_index.flush()
+
+
+def update_novels_threaded():
+    """多线程更新小说：目录页扫描与下载流水线并行"""
+    print("\n====== 多线程更新小说 ======")
+    start_metrics()
+    run_book_pipeline(scan_index_pages, "index-scanner")
+    print("多线程更新完成！")
+
+
+def backfill_novels_threaded():
+    """多线程补全旧小说：多本书在全局限速下并行抓取，中断后从断点续抓"""
+    print("\n====== 多线程补全旧小说 ======")
+    start_metrics()
+    run_book_pipeline(queue_backfill, "backfill-planner")
+    print("补全完成！")
+
+
+# ---------- 分布式抓取（节点） ----------
+# 目录页与书都作为任务发布到共享队列：目录页任务解析出书目后发布书任务和下一页；
+# 书任务由领到的节点整本抓完（章节按源码顺序写出，tid 探测逐个判定，不宜拆到多个节点），
+# 章节级进度靠共享输出目录里的断点保存，节点宕机后别的节点领到这本书时从断点续抓。
+def cluster_budget(nodes):
+    """全站礼貌预算按在线节点数平分，每个节点不超过自己的 RATE / BURST"""
+    rate = min(RATE, CLUSTER_RATE / max(1, nodes))
+    return rate, max(1, min(BURST, round(BURST * rate / RATE)))
+
+
+class Node:
+    """一个抓取节点：领取任务、后台续租、按在线节点数分摊限速"""
+
+    def __init__(self, work_queue, name=None):
+        self.queue = work_queue
+        self.name = name or f"{socket.gethostname()}-{os.getpid()}"
+        self.nodes = 0
+        self._held = set()
+        self._lock = Lock()
+        self._stop = Event()
+        self._thread = None
+
+    def start(self):
+        self.beat()
+        self._thread = Thread(target=self._heartbeat, name="cluster-heartbeat", daemon=True)
+        self._thread.start()
+
+    def _heartbeat(self):
+        while not self._stop.wait(LEASE_TTL / 3):
+            try:
+                self.beat()
+            except sqlite3.Error as e:
+                with print_lock:
+                    print(f"[cluster] 心跳失败: {e}")
+
+    def beat(self):
+        """登记在线、续租手上的任务，在线节点数变化时重新分摊限速"""
+        nodes = self.queue.beat(self.name, LEASE_TTL)
+        if nodes != self.nodes:
+            self.nodes = nodes
+            rate, burst = cluster_budget(nodes)
+            rate_limiter.rebase(rate, burst)
+            with print_lock:
+                print(f"[cluster] 在线节点 {nodes} 个，本节点限速 {rate:.2f} 次/秒")
+        with self._lock:
+            held = set(self._held)
+        if held:
+            lost = held - self.queue.renew(self.name, held, LEASE_TTL)
+            if lost:
+                with print_lock:
+                    print(f"[cluster] {len(lost)} 个任务的租约已过期，可能被其他节点重新领取")
+
+    def claim(self):
+        job = self.queue.claim(self.name, LEASE_TTL)
+        if job is not None:
+            with self._lock:
+                self._held.add(job.id)
+        return job
+
+    def finish(self, job, ok, error=None):
+        with self._lock:
+            self._held.discard(job.id)
+        if ok:
+            done = self.queue.complete(self.name, job.id)
+        else:
+            done = self.queue.fail(self.name, job.id, error or "failed")
+        if not done:
             with print_lock:
-                print(f"[warn] get {url} error: {e}  retry {attempt + 1}/{RETRY}...")
-            if attempt < RETRY - 1:
-                time.sleep(1)
+                print(f"[cluster] {job.id} 的租约已不属于本节点，结果不再登记")
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.queue.leave(self.name)
+        rate_limiter.rebase(RATE, BURST)
+
+
+def run_page_job(node, job):
+    """目录页任务：书目发布为书任务（按页序排队），本页有书时再发布下一页"""
+    p = job.payload["page"]
+    html = get_html(INDEX_BASE.format(p))
+    if not html:
+        with print_lock:
+            print(f"第{p}页下载失败")
+        node.finish(job, False, "index page failed")
+        return
+    novels = list_novels_one_page(html)
+    jobs = [(f"book:{info['title']}", "book", info, p) for info in novels]
+    if novels and p < MAX_PAGES:
+        jobs.append((f"page:{p + 1}", "page", {"page": p + 1}, 0))
+    # 同一本书在翻页期间可能出现在两页，任务 id 相同只会发布一次
+    node.queue.publish(jobs)
+    with print_lock:
+        if novels:
+            print(f"\n------ 第{p}页 共{len(novels)} 本，已发布到任务队列 ------")
+        else:
+            print(f"第{p}页无新书，结束翻页")
+    node.finish(job, True)
+
+
+def run_book_job(node, job, open_books):
+    """书任务：与单机相同，新书整本下载（有断点时续抓），有清单的书检查新章节，没有清单的旧文件跳过"""
+    info = job.payload
+    try:
+        to_download, to_update = plan_page([info])
+    except BaseException:
+        open_books.release()
+        raise
+    if not to_download and not to_update:
+        open_books.release()
+        node.finish(job, True)
+        return
+    manifest = to_update[0][1] if to_update else None
+    start_book(info, manifest, open_books, lambda ok: node.finish(job, ok, None if ok else "book failed"))
+
+
+def cluster_worker(node, open_books):
+    """节点上的消费者：不断领取任务，队列里既没有排队也没有租出的任务时退出。
+    先占到在抓书目的名额再领取，手上的书不会超过本节点能同时处理的数量"""
+    while True:
+        open_books.acquire()
+        job = node.claim()
+        if job is None or job.kind != "book":
+            open_books.release()
+        if job is None:
+            counts = node.queue.counts()
+            if not counts.get("queued") and not counts.get("leased") and counts:
+                return
+            # 还有任务在别的节点（或本节点的调度器）里，等它们完成或租约过期
+            time.sleep(QUEUE_POLL)
+            continue
+        try:
+            if job.kind == "page":
+                run_page_job(node, job)
+            elif job.kind == "book":
+                run_book_job(node, job, open_books)
+            else:
+                node.finish(job, False, f"unknown kind {job.kind}")
         except Exception as e:
             with print_lock:
-                print(f"[error] Unexpected error: {e}")
+                print(f"[error] 任务 {job.id} 失败: {e}")
+            node.finish(job, False, str(e))
+
+
+def run_cluster_node(seed=False):
+    """分布式抓取节点。seed=True 时开始新一轮（清掉上一轮的记录、发布第 1 个目录页），
+    整轮只需一个节点这样做，其余节点直接加入；所有任务完成后各节点退出"""
+    print("\n====== 分布式抓取 ======")
+    start_metrics()
+    work_queue = open_work_queue()
+    if seed:
+        work_queue.reset()
+        work_queue.publish([("page:1", "page", {"page": 1}, 0)])
+    node = Node(work_queue)
+    node.start()
+    print(f"[cluster] 节点 {node.name} 已加入")
+    n_workers = max(1, MAX_WORKERS // 2)
+    open_books = Semaphore(CLUSTER_OPEN_BOOKS)
+    workers = [Thread(target=cluster_worker, args=(node, open_books), name=f"cluster-{i}")
+               for i in range(n_workers)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    get_scheduler().wait_idle()
+    node.stop()
+
+    counts = work_queue.counts()
+    print(f"[cluster] 任务完成 {counts.get('done', 0)} 个，失败 {counts.get('failed', 0)} 个")
+    # 其他节点也在写状态库，导出前重新读入整表
+    state_store.reload()
+    merge_lists()
+    http_cache.report()
+    report_metrics()
+    tid_index.flush()
+    dedup_index.flush()
+    print("分布式抓取完成！")
+
+
+# ---------- 监视模式（只抓目录页上变化的书） ----------
+def load_watch_snapshot():
+    try:
+        with open(WATCH_FILE, 'r', encoding='utf-8') as f:
+            return [tuple(e) for e in json.load(f)]
+    except (OSError, ValueError):
+        return None
+
+
+def save_watch_snapshot(entries):
+    tmp = f"{WATCH_FILE}.{os.getpid()}.tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(entries, f, ensure_ascii=False)
+    os.replace(tmp, WATCH_FILE)
+
+
+def diff_snapshot(old, novels):
+    """目录页上相对上次快照新出现、或被顶到原先排在它前面的书之前的书；没有快照时全部算变化。
+
+    只比较相对顺序：上面的书被移出目录页时，下面的书整体上移不算变化。
+    """
+    if old is None:
+        return list(novels)
+    pos = {entry: i for i, entry in enumerate(old)}
+    changed = []
+    lowest = len(old)   # 后面各书在旧快照中的最小位置
+    for info in reversed(novels):
+        i = pos.get((info["tid"], info["title"]))
+        if i is None or i > lowest:
+            changed.append(info)
+        if i is not None:
+            lowest = min(lowest, i)
+    changed.reverse()
+    return changed
+
+
+def poll_index(pages):
+    """抓前 pages 个目录页（有缓存时发条件请求），返回书目列表；有页面下载失败时返回 None"""
+    novels, seen = [], set()
+    for p in range(1, pages + 1):
+        html = get_html(INDEX_BASE.format(p))
+        if not html:
+            with print_lock:
+                print(f"第{p}页下载失败，本轮跳过")
+            return None
+        page = list_novels_one_page(html)
+        if not page:
             break
-    return None
+        novels += [info for info in page if info["title"] not in seen]
+        seen.update(info["title"] for info in page)
+    return novels
 
 
-# ---------- 工具函数 ----------
-def safe_filename(name):
-    name = re.sub(r'<[^>]+>', '', name)
-    name = re.sub(r'[\\/:*?"<>|\s]', '_', name)
-    return name.strip('. ') or 'untitled'
+def queue_changed(novels, jobs, n_workers):
+    """生产者：只把变化的书放进队列"""
+    try:
+        to_download, to_update = plan_page(novels)
+        with print_lock:
+            print(f"\n------ 变化 {len(novels)} 本：新书 {len(to_download)} 本，检查更新 {len(to_update)} 本 ------")
+        for job in [(info, None) for info in to_download] + to_update:
+            jobs.put(job)
+    finally:
+        for _ in range(n_workers):
+            jobs.put(None)
 
 
-def read_list(path):
-    if not os.path.exists(path):
-        return []
-    with open(path, 'r', encoding='utf-8') as f:
-        return [line.strip() for line in f if line.strip()]
+def watch_novels(interval=None, pages=None):
+    """常驻监视：每隔 interval 秒抓前 pages 个目录页，与上次快照比较，只抓新出现或被顶上来的书；Ctrl+C 退出"""
+    interval = WATCH_INTERVAL if interval is None else interval
+    pages = WATCH_PAGES if pages is None else pages
+    print(f"\n====== 监视模式：每 {interval:g} 秒检查前 {pages} 个目录页（Ctrl+C 退出） ======")
+    start_metrics()
+    snapshot = load_watch_snapshot()
+    try:
+        while True:
+            started = time.monotonic()
+            novels = poll_index(pages)
+            if novels is not None:
+                changed = diff_snapshot(snapshot, novels)
+                stamp = time.strftime("%H:%M:%S")
+                failed = set()      # 本轮没抓成的书（新书下载失败，或已有的书检查更新失败）
+                if changed:
+                    print(f"[watch] {stamp} 目录页有 {len(changed)} 本变化")
+                    run_book_pipeline(lambda jobs, n: queue_changed(changed, jobs, n), "watch",
+                                      lambda info, ok: ok or failed.add(info["title"]))
+                else:
+                    print(f"[watch] {stamp} 无变化")
+                # 没抓成的书不记入快照，下一轮仍算作变化：已有的书更新失败时状态仍是 done，只能按本轮结果判断
+                snapshot = [(info["tid"], info["title"]) for info in novels
+                            if info["title"] not in failed and state_store.status(info["title"]) != "failed"]
+                save_watch_snapshot(snapshot)
+            time.sleep(max(0.0, interval - (time.monotonic() - started)))
+    except KeyboardInterrupt:
+        print("\n监视结束")
+        state_store.flush()
+        tid_index.flush()
+        dedup_index.flush()
 
 
-def write_list(path, lst):
-    with open(path, 'w', encoding='utf-8') as f:
-        for s in lst:
-            f.write(s + '\n')
+def merge_lists():
+    """状态库落盘后导出 main.list；temp.list 启动时已并入状态库，直接删除"""
+    state_store.flush()
+    state_store.export_list(MAIN_LIST)
+    if os.path.exists(TEMP_LIST):
+        os.remove(TEMP_LIST)
+    print(f"[state] 已完成 {len(state_store.titles('done'))} 本，main.list 已更新")
 
 
-def extract_title(html):
-    raw = re.search(r'<title>(.*?)</title>', html, flags=re.I | re.S)
-    if not raw:
-        return ""
-    return re.split(r'[（(]', raw.group(1).strip(), maxsplit=1)[0].strip()[:30]
+# ---------- 异步抓取（asyncio） ----------
+# 所有请求（目录页、首页、章节）共用一个并发闸门，在途请求数由自适应并发控制器决定
+async def read_probe_async(r, base_prefix):
+    """read_probe 的异步版本"""
+    scanner = HeadScanner()
+    async for chunk in r.content.iter_chunked(PROBE_CHUNK):
+        if scanner.feed(chunk):
+            break
+    prefix = extract_title(scanner.head())
+    if prefix != base_prefix:
+        r.close()  # 不读剩余正文，直接断开连接
+        metrics.inc("http_bytes_total", sum(map(len, scanner.parts)), kind="probe")
+        return None, prefix
+    scanner.parts.append(await r.read())
+    return b"".join(scanner.parts), prefix
 
 
-def extract_text(html):
-    txt = []
-    for m in re.findall(r'<div[^>]*class=["\']quote["\'][^>]*>(.*?)</div>', html, flags=re.I | re.S):
-        m = re.sub(r'<br\s*/?>', '\n', m, flags=re.I)
-        txt.append(re.sub(r'<[^>]+>', '', m))
-    if not txt:
-        divs = re.findall(r'<div[^>]*>(.*?)</div>', html, flags=re.I | re.S)
-        if divs:
-            longest = max(divs, key=len)
-            longest = re.sub(r'<br\s*/?>', '\n', longest, flags=re.I)
-            txt.append(re.sub(r'<[^>]+>', '', longest))
-    return "\n".join(txt).strip()
+async def fetch_body_async(http, sem, url, max_age=None, base_prefix=None):
+    """fetch_body 的异步版本，受全局并发信号量约束，与线程版共用磁盘缓存"""
+    entry = http_cache.load(url)
+    if entry is not None:
+        if max_age is None:
+            max_age = cache_max_age(url)
+        if http_cache.is_fresh(entry, max_age):
+            http_cache.count("hit")
+            http_cache.touch(url)
+            return entry["body"], None
+    kind = request_kind(url, base_prefix)
+    for attempt in range(RETRY):
+        while circuit_breaker.delay() > 0:
+            await asyncio.sleep(circuit_breaker.delay())
+        # 先取令牌再占并发名额，等待限速时不占用信号量
+        await asyncio.sleep(rate_limiter.reserve(url))
+        if attempt == 0:
+            retry_budget.deposit()
+        r = None
+        try:
+            async with sem.slot():
+                start = time.perf_counter()
+                try:
+                    async with http.get(url, headers=http_cache.validators(entry) if entry else None) as r:
+                        metrics.observe("http_ttfb_seconds", time.perf_counter() - start, kind=kind)
+                        metrics.inc("http_requests_total", kind=kind, status=r.status)
+                        if r.status in (429, 503):
+                            rate_limiter.throttled(url, parse_retry_after(r.headers.get("Retry-After")))
+                        else:
+                            rate_limiter.succeeded(url)
+                        if r.status < 400:
+                            circuit_breaker.record(True)
+                        if r.status == 304 and entry is not None:
+                            http_cache.count("revalidated")
+                            http_cache.refresh(url, entry, r.headers)
+                            return entry["body"], None
+                        r.raise_for_status()
+                        status = "redirect" if r.history else "ok"
+                        if base_prefix is None:
+                            body = await r.read()
+                        else:
+                            body, prefix = await read_probe_async(r, base_prefix)
+                            if body is None:
+                                record_tid(url, status, prefix, r.headers.get("Content-Length"))
+                                return None, prefix
+                        headers = r.headers
+                finally:
+                    metrics.observe("http_request_seconds", time.perf_counter() - start, kind=kind)
+                    if r is not None:
+                        # 旧版 aiohttp 没有 total_raw_bytes，只能记解压后的字节数
+                        wire = getattr(r.content, "total_raw_bytes", None)
+                        metrics.inc("http_wire_bytes_total", wire if wire is not None else r.content.total_bytes,
+                                    kind=kind)
+            metrics.inc("http_bytes_total", len(body), kind=kind)
+            http_cache.count("miss")
+            http_cache.store(url, body, headers)
+            record_tid(url, status, extract_title(body), len(body))
+            return body, None
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            delay = after_failure(url, attempt, e, getattr(e, "status", None))
+            if delay is None:
+                break
+            await asyncio.sleep(delay)
+    return None, None
 
 
-def list_novels_one_page(html):
-    novels = []
-    for url, tid, title in re.findall(r'<a\s+href=["\']([^"\']*tid=(\d+)[^"\']*)["\'][^>]*>(.*?)</a>', html, flags=re.I):
-        if "act=thread" in url or "act=threadview" in url:
-            title = safe_filename(title.strip())
-            novels.append({"title": title, "url": urljoin(BASE_URL, url), "tid": int(tid)})
-    seen = set(); res = []
-    for n in novels:
-        if n["tid"] not in seen:
-            seen.add(n["tid"])
-            res.append(n)
-    return res
+async def get_body_async(http, sem, url, max_age=None):
+    """异步版 get_body"""
+    return (await fetch_body_async(http, sem, url, max_age))[0]
 
 
-def clean_final(text: str, inner_titles: list) -> str:
-    # 1. 连续两个半角空格 -> 硬回车+两个半角空格
-    text = re.sub(r'  +', '\n  ', text)
-    # 2. 连续两个全角空格 -> 硬回车+两个全角空格
-    text = re.sub(r'　　+', '\n　　', text)
-    # 3. 删除内链标题
-    for t in inner_titles:
-        text = text.replace(t, '')
-    # 4. 删除所有半角/全角空格
-    text = re.sub(r'[ \u00A0\u3000]+', '', text)
-    # 5. 删除纯空段
-    lines = [ln for ln in text.splitlines() if ln.strip()]
-    # 6. 每段前加两个全角空格
-    lines = ['　　' + ln for ln in lines]
-    return '\n'.join(lines)
+async def get_html_async(http, sem, url, max_age=None):
+    """异步版 get_html"""
+    body = await get_body_async(http, sem, url, max_age)
+    return decode_body(body) if body is not None else None
 
 
-# ---------- 多线程抓取函数 ----------
-def fetch_page(url):
-    """获取单个页面的内容"""
-    html = get_html(url)
-    if html:
-        return url, html, extract_text(html)
-    return url, None, None
+async def fetch_in_order(http, sem, urls, window=REORDER_WINDOW):
+    """按 urls 顺序逐个产出 (url, 页面字节)，同时最多 window 个请求在排队或进行中"""
+    pending = []
+    it = iter(urls)
+    for url in it:
+        pending.append((url, asyncio.ensure_future(get_body_async(http, sem, url))))
+        if len(pending) >= window:
+            break
+    while pending:
+        url, task = pending.pop(0)
+        h = await task
+        nxt = next(it, None)
+        if nxt is not None:
+            pending.append((nxt, asyncio.ensure_future(get_body_async(http, sem, nxt))))
+        yield url, h
 
 
-def crawl_one_threaded(info):
-    """多线程优化的单本小说抓取"""
+async def crawl_one_async(http, sem, info, manifest=None):
+    """异步单本小说抓取，输出与同步版一致（内链按源码倒序，tid 逐个判定）；成功时返回 True"""
     title, first_url, start_tid = info["title"], info["url"], info["tid"]
-    with print_lock:
+    incremental = manifest is not None
+    if incremental:
+        print(f"【check】{title}  （上次抓到 tid={manifest['last_tid']}）")
+    else:
         print(f"【start】{title}  （首tid={start_tid}）")
-    
-    html = get_html(first_url)
+
+    html = await get_html_async(http, sem, first_url, max_age=0 if incremental else None)
     if not html:
-        with print_lock:
-            print(f"[fail] 首页下载失败 {first_url}")
-        return
-    
+        print(f"[fail] 首页下载失败 {first_url}")
+        return False
+
     base_prefix = extract_title(html)
-    full_text = [extract_text(html)]
-    inner_titles = []
+    inner_links = find_inner_links(html, first_url)
+    inner_titles = [txt for _, txt in inner_links]
+    writer, manifest = open_writer(info, manifest, inner_titles, bounded=False)
+    try:
+        await crawl_chapters_async(http, sem, writer, html, inner_links, base_prefix, manifest)
+    except BaseException:
+        writer.abort()
+        raise
+    # 收尾的清洗与写盘放到线程里，避免阻塞事件循环
+    await asyncio.to_thread(writer.close)
+    save_manifest(manifest)
+    return True
 
-    # ---------- 内链处理（并行） ----------
-    inner_links = []
-    for url, txt in re.findall(r'<a\s+href=["\']([^"\']*tid=\d+[^"\']*)["\'][^>]*>([^<]*\d+[^<]*)</a>', html, flags=re.I):
-        full = urljoin(first_url, url)
-        txt = re.sub(r'<[^>]+>', '', txt).strip()
-        if re.search(r'\d+', txt):
-            inner_links.append((full, txt))
-            inner_titles.append(txt)
 
+async def crawl_chapters_async(http, sem, writer, html, inner_links, base_prefix, manifest):
+    """异步抓取首页之后的章节；结果已按顺序到达，写出器不会阻塞事件循环"""
+    incremental = writer.append or writer.resumed
+    seq = 0
+    if not incremental:
+        writer.put(seq, extract_text(html))
+        seq += 1
+
+    # ---------- 内链处理（并发，结果按提交顺序） ----------
     if inner_links:
-        with print_lock:
-            print(f"    发现 {len(inner_links)} 个内链章节，并行抓取...")
-        
-        # 使用线程池并行抓取内链
-        urls = [url for url, _ in reversed(inner_links)]
-        with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(urls))) as executor:
-            future_to_url = {executor.submit(fetch_page, url): url for url in urls}
-            for future in as_completed(future_to_url):
-                url, html_content, text_content = future.result()
-                if text_content:
-                    full_text.append(text_content)
-        
-        with print_lock:
-            print(f"    内链并行抓取完成")
+        manifest["mode"] = "inner"
+        done = skipped_tids(manifest)
+        urls = [url for url, _ in reversed(inner_links) if tid_of(url) not in done]
+        if urls:
+            print(f"    发现 {len(urls)} 个{'新' if incremental else ''}内链章节，异步抓取...")
+            dups = {url for url in urls if writer.dedup is not None and writer.dedup.known_dup(tid_of(url))}
+            pages = fetch_in_order(http, sem, [url for url in urls if url not in dups])
+            for url in urls:
+                if url in dups:
+                    h = None
+                    record_chapter(manifest, tid_of(url))
+                else:
+                    url, h = await pages.__anext__()
+                    if h is not None:
+                        record_chapter(manifest, tid_of(url))
+                    else:
+                        record_missing(manifest, tid_of(url))
+                writer.put(seq, extract_text(h) if h else None, tid=tid_of(url))
+                seq += 1
+            print(f"    内链异步抓取完成")
 
-    # ---------- tid 递增（批量并行） ----------
+    # ---------- tid 递增（自适应投机窗口，按 tid 顺序判定） ----------
     else:
-        with print_lock:
-            print("    无内链，启用并行 tid 递增。")
-        
-        tid = start_tid + 1
+        manifest["mode"] = "tid"
+        print("    无内链，启用异步 tid 递增。")
+        next_check = next_submit = manifest["last_tid"] + 1
+        window = PROBE_WINDOW_MIN
         fail_streak = 0
-        batch_size = MAX_WORKERS  # 每批数量等于线程数
-        
+        inflight = {}
+        dups = set()
+        known = KnownTids(tid_index)
+        stats = {"requests": 0, "chapters": 0, "cut": 0, "indexed": 0}
         while fail_streak < 3:
-            # 准备一批URL
-            batch_urls = [f"{BASE_URL}{tid + i}" for i in range(batch_size)]
-            
-            # 并行抓取
-            with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-                future_to_url = {executor.submit(fetch_page, url): url for url in batch_urls}
-                results = []
-                for future in as_completed(future_to_url):
-                    url, html_content, text_content = future.result()
-                    if html_content:
-                        current_tid = int(url.split('=')[-1])
-                        curr_prefix = extract_title(html_content)
-                        results.append((current_tid, curr_prefix, text_content))
-            
-            # 处理结果
-            results.sort()  # 按tid排序
-            success_count = 0
-            
-            for current_tid, curr_prefix, text_content in results:
-                if curr_prefix == base_prefix:
-                    if fail_streak > 0:
-                        with print_lock:
-                            print(f"    tid={current_tid}  前缀恢复一致")
-                    fail_streak = 0
-                    if text_content:
-                        full_text.append(text_content)
-                        success_count += 1
-                else:
-                    fail_streak += 1
-            
-            if success_count > 0:
-                with print_lock:
-                    print(f"    并行抓取成功 {success_count} 个页面")
+            while next_submit < next_check + window:
+                if writer.dedup is not None and writer.dedup.known_dup(next_submit):
+                    dups.add(next_submit)
+                elif known.foreign_prefix(next_submit, base_prefix) is None:
+                    inflight[next_submit] = asyncio.ensure_future(
+                        fetch_body_async(http, sem, f"{BASE_URL}{next_submit}", base_prefix=base_prefix))
+                next_submit += 1
+            task = inflight.pop(next_check, None)
+            if next_check in dups:
+                h = None
+            elif task is None:
+                h = None
+                stats["indexed"] += 1
             else:
-                with print_lock:
-                    print(f"    并行抓取失败，fail_streak={fail_streak}")
-            
-            tid += batch_size
-            time.sleep(random.uniform(MIN_DELAY, MAX_DELAY))
-
-    # ================= 保存文件 =================
-    merged = clean_final('\n'.join(full_text), inner_titles)
-    fname = os.path.join(OUTPUT_DIR, title + ".txt")
-    
-    with file_lock:
-        with open(fname, "w", encoding="utf-8") as f:
-            f.write(merged)
-        with print_lock:
-            print(f"【saved】{fname}\n")
+                h, cut_prefix = await task
+                stats["requests"] += 1
+                stats["cut"] += cut_prefix is not None
+            manifest["probed_tid"] = max(manifest["probed_tid"], next_check)
+            # 上次判为重复的本书章节算作前缀一致，不再下载
+            if next_check in dups or (h is not None and extract_title(h) == base_prefix):
+                fail_streak = 0
+                record_chapter(manifest, next_check)
+                text_content = extract_text(h) if h is not None else None
+                if text_content:
+                    writer.put(seq, text_content, tid=next_check)
+                    seq += 1
+                    stats["chapters"] += 1
+            else:
+                fail_streak += 1
+            window = next_probe_window(window, fail_streak)
+            next_check += 1
 
+        for task in inflight.values():
+            if task.done():
+                stats["requests"] += 1
+                stats["cut"] += task.result()[1] is not None
+            else:
+                task.cancel()
+        log_probe_stats(writer.title, stats, base_prefix, next_check - 1)
 
-# ---------- 主函数 ----------
-def update_novels_threaded():
-    """多线程更新小说"""
-    print("\n====== 多线程更新小说 ======")
-    main_list = read_list(MAIN_LIST)
-    temp_list = read_list(TEMP_LIST)
-    
-    p = 1
-    while p <= MAX_PAGES:
-        index_url = INDEX_BASE.format(p)
-        html = get_html(index_url)
-        if not html:
-            print(f"第{p}页下载失败，跳过")
-            p += 1
-            continue
-            
-        novels = list_novels_one_page(html)
-        if not novels:
-            print(f"第{p}页无新书，结束翻页")
-            break
-            
-        print(f"\n------ 第{p}页 共{len(novels)} 本 ------")
-        
-        # 筛选需要下载的小说
-        to_download = []
-        for info in novels:
-            title = info["title"]
-            if os.path.exists(os.path.join(OUTPUT_DIR, title + ".txt")):
+
+async def scan_index_pages_async(http, sem, jobs, n_workers):
+    """scan_index_pages 的异步版本"""
+    seen = set()
+    try:
+        for p in range(1, MAX_PAGES + 1):
+            html = await get_html_async(http, sem, INDEX_BASE.format(p))
+            if not html:
+                print(f"第{p}页下载失败，跳过")
                 continue
-            to_download.append(info)
-        
-        if to_download:
-            print(f"    需要下载 {len(to_download)} 本新书，开始多线程下载...")
-            
-            # 使用线程池并行下载多本小说
-            with ThreadPoolExecutor(max_workers=min(MAX_WORKERS//2, len(to_download))) as executor:
-                future_to_info = {executor.submit(crawl_one_threaded, info): info for info in to_download}
-                for future in as_completed(future_to_info):
-                    try:
-                        future.result()
-                    except Exception as e:
-                        info = future_to_info[future]
-                        print(f"[error] 下载 {info['title']} 失败: {e}")
-            
-            # 批量更新临时列表
-            with file_lock:
-                with open(TEMP_LIST, 'a', encoding='utf-8') as f:
-                    for info in to_download:
-                        f.write(info["title"] + '\n')
-        
-        print(f"------ 第{p}页处理完成 ------")
-        p += 1
-    
+
+            novels = list_novels_one_page(html)
+            if not novels:
+                print(f"第{p}页无新书，结束翻页")
+                break
+
+            novels = [info for info in novels if info["title"] not in seen]
+            seen.update(info["title"] for info in novels)
+            to_download, to_update = plan_page(novels)
+            print(f"\n------ 第{p}页 共{len(novels)} 本：新书 {len(to_download)} 本，检查更新 {len(to_update)} 本 ------")
+            for job in [(info, None) for info in to_download] + to_update:
+                await jobs.put(job)
+    finally:
+        for _ in range(n_workers):
+            await jobs.put(None)
+
+
+async def book_worker_async(http, sem, jobs):
+    """book_worker 的异步版本"""
+    while True:
+        job = await jobs.get()
+        if job is None:
+            return
+        info, manifest = job
+        if manifest is None:
+            state_store.mark(info["title"], "downloading", info["tid"])
+        ok = False
+        try:
+            ok = await crawl_one_async(http, sem, info, manifest)
+        except Exception as e:
+            print(f"[error] 下载 {info['title']} 失败: {e}")
+        if manifest is None or ok:
+            state_store.mark(info["title"], "done" if ok else "failed")
+
+
+def metrics_trace_config():
+    """aiohttp 的请求跟踪：单独记录 DNS 解析与建连（含 TLS）耗时，只有新建连接时才会触发"""
+    trace = aiohttp.TraceConfig()
+
+    async def dns_start(session, ctx, params):
+        ctx.dns_start = time.perf_counter()
+
+    async def dns_end(session, ctx, params):
+        metrics.observe("http_dns_seconds", time.perf_counter() - ctx.dns_start)
+
+    async def connect_start(session, ctx, params):
+        ctx.connect_start = time.perf_counter()
+
+    async def connect_end(session, ctx, params):
+        metrics.observe("http_connect_seconds", time.perf_counter() - ctx.connect_start)
+
+    trace.on_dns_resolvehost_start.append(dns_start)
+    trace.on_dns_resolvehost_end.append(dns_end)
+    trace.on_connection_create_start.append(connect_start)
+    trace.on_connection_create_end.append(connect_end)
+    return trace
+
+
+async def queue_backfill_async(http, sem, jobs, n_workers):
+    """queue_backfill 的异步版本；补 tid 最多翻几页目录，直接在线程里走同步请求"""
+    try:
+        for info in await asyncio.to_thread(plan_backfill):
+            await jobs.put((info, None))
+    finally:
+        for _ in range(n_workers):
+            await jobs.put(None)
+
+
+async def run_book_pipeline_async(produce):
+    """run_book_pipeline 的异步版本：produce(http, sem, jobs, n_workers) 为生产者协程"""
+    sem = AsyncConcurrencyGate(concurrency)
+    connector = aiohttp.TCPConnector(limit=MAX_CONCURRENCY if AUTO_TUNE else MAX_WORKERS)
+    timeout = aiohttp.ClientTimeout(total=TIMEOUT)
+    # 同时进行的书数不限制请求数，真正的并发上限始终是信号量
+    n_workers = MAX_WORKERS
+    jobs = asyncio.Queue(maxsize=BOOK_QUEUE_SIZE)
+    traces = [metrics_trace_config()] if metrics.enabled else []
+    async with aiohttp.ClientSession(headers=HEADERS, connector=connector, timeout=timeout,
+                                     trace_configs=traces) as http:
+        await asyncio.gather(produce(http, sem, jobs, n_workers),
+                             *(book_worker_async(http, sem, jobs) for _ in range(n_workers)))
+
     merge_lists()
-    print("多线程更新完成！")
+    http_cache.report()
+    report_metrics()
+    tid_index.flush()
+    dedup_index.flush()
 
 
-def merge_lists():
-    main = read_list(MAIN_LIST)
-    temp = read_list(TEMP_LIST)
-    if temp:
-        write_list(MAIN_LIST, temp + main)
-        if os.path.exists(TEMP_LIST):
-            os.remove(TEMP_LIST)
-        print("已合并列表，临时列表已删除。")
+async def update_novels_async():
+    """异步更新小说：目录页扫描与下载流水线并行"""
+    print("\n====== 异步更新小说 ======")
+    start_metrics()
+    await run_book_pipeline_async(scan_index_pages_async)
+    print("异步更新完成！")
+
+
+async def backfill_novels_async():
+    """异步补全旧小说，中断后从断点续抓"""
+    print("\n====== 异步补全旧小说 ======")
+    start_metrics()
+    await run_book_pipeline_async(queue_backfill_async)
+    print("补全完成！")
+
+
+def run_async(main):
+    """异步模式入口"""
+    if aiohttp is None:
+        print("异步模式需要 aiohttp：pip install aiohttp")
+        return
+    asyncio.run(main())
+
+
+def run_async_update():
+    run_async(update_novels_async)
+
+
+def run_async_backfill():
+    run_async(backfill_novels_async)
 
 
 # ---------- 菜单 ----------
@@ -332,13 +3879,28 @@ def menu():
     while True:
         print("\n=========  禁忌书屋抓取器（多线程版）  =========")
         print("1. 多线程更新小说")
-        print("2. 调整线程数")
+        print("2. 并发与限速设置")
+        print("3. 异步更新小说（需 aiohttp）")
+        print("4. 补全旧小说（并行，断点续抓）")
+        print("5. 异步补全旧小说（需 aiohttp）")
+        print("6. 分布式：开始新一轮并参与抓取")
+        print("7. 分布式：加入已有的任务队列")
         print("0. 退出")
         choice = input("请选择：").strip()
         if choice == "1":
             update_novels_threaded()
         elif choice == "2":
-            adjust_threads()
+            adjust_settings()
+        elif choice == "3":
+            run_async_update()
+        elif choice == "4":
+            backfill_novels_threaded()
+        elif choice == "5":
+            run_async_backfill()
+        elif choice == "6":
+            run_cluster_node(seed=True)
+        elif choice == "7":
+            run_cluster_node()
         elif choice == "0":
             print("再见！")
             break
@@ -346,30 +3908,135 @@ def menu():
             print("输入有误，请重选")
 
 
-def adjust_threads():
-    """调整线程数"""
-    global MAX_WORKERS, MIN_DELAY, MAX_DELAY
+def adjust_settings():
+    """并发范围、限速与解析进程数；并发数本身由自动调速决定，不再手动猜测"""
+    global RATE, BURST, PARSE_PROCESSES
     print(f"\n当前配置：")
-    print(f"最大线程数: {MAX_WORKERS}")
-    print(f"延迟范围: {MIN_DELAY}-{MAX_DELAY}秒")
-    
+    if AUTO_TUNE:
+        print(f"并发: 自动调整 {MIN_CONCURRENCY}-{MAX_CONCURRENCY}（当前 {int(concurrency.limit)}）")
+    else:
+        print(f"并发: 固定 {MAX_WORKERS}")
+    print(f"限速: {RATE} 次/秒，突发 {BURST}")
+    print(f"解析进程数: {PARSE_PROCESSES}（0 表示在抓取线程内解析）")
+
     try:
-        new_workers = input(f"输入新的线程数（当前{MAX_WORKERS}，回车跳过）：").strip()
-        if new_workers:
-            MAX_WORKERS = int(new_workers)
-            
-        new_min_delay = input(f"输入最小延迟（当前{MIN_DELAY}，回车跳过）：").strip()
-        if new_min_delay:
-            MIN_DELAY = float(new_min_delay)
-            
-        new_max_delay = input(f"输入最大延迟（当前{MAX_DELAY}，回车跳过）：").strip()
-        if new_max_delay:
-            MAX_DELAY = float(new_max_delay)
-            
+        new_range = input("输入并发范围（如 2-32 自动调整；单个数字为固定并发；回车跳过）：").strip()
+        if new_range:
+            set_concurrency(new_range)
+
+        new_rate = input(f"输入每秒请求数（当前{RATE}，回车跳过）：").strip()
+        if new_rate:
+            RATE = float(new_rate)
+
+        new_burst = input(f"输入突发请求数（当前{BURST}，回车跳过）：").strip()
+        if new_burst:
+            BURST = int(new_burst)
+
+        new_procs = input(f"输入解析进程数（当前{PARSE_PROCESSES}，本机 {os.cpu_count()} 核，回车跳过）：").strip()
+        if new_procs:
+            PARSE_PROCESSES = int(new_procs)
+
+        apply_settings()
         print("参数更新成功！")
     except ValueError:
         print("输入无效，保持原设置")
 
 
+def set_concurrency(text):
+    """「2-32」为自动调整范围，单个数字为固定并发；格式不对时抛出 ValueError"""
+    global MAX_WORKERS, AUTO_TUNE, MIN_CONCURRENCY, MAX_CONCURRENCY
+    low, _, high = text.partition("-")
+    if high:
+        MIN_CONCURRENCY, MAX_CONCURRENCY = sorted((max(1, int(low)), max(1, int(high))))
+        AUTO_TUNE = True
+    else:
+        MAX_WORKERS = max(1, int(low))
+        AUTO_TUNE = False
+
+
+def apply_settings():
+    """按当前配置重建限速器、并发控制器、连接池、调度器与解析进程池"""
+    rate_limiter.configure(RATE, BURST)
+    concurrency.configure(MAX_WORKERS, MIN_CONCURRENCY, MAX_CONCURRENCY, AUTO_TUNE)
+    mount_adapter()
+    reset_scheduler()
+    reset_parse_pool()
+    dedup_index.enabled = DEDUP != "off"
+
+
+# ---------- 命令行 ----------
+def parse_args(argv=None):
+    ap = argparse.ArgumentParser(description="禁忌书屋抓取器（多线程版）。不指定模式时进入交互菜单")
+    mode = ap.add_mutually_exclusive_group()
+    mode.add_argument("--update", action="store_true", help="更新小说（菜单 1，加 --async 为菜单 3）")
+    mode.add_argument("--backfill", action="store_true", help="补全旧小说（菜单 4，加 --async 为菜单 5）")
+    mode.add_argument("--watch", action="store_true", help="常驻监视前几个目录页，只抓新出现或被顶上来的书")
+    mode.add_argument("--cluster", choices=("seed", "join"), help="分布式节点：seed 开始新一轮，join 加入已有队列")
+    mode.add_argument("--export", metavar="DIR", help="把打包归档导出为 DIR/书名.txt（可用 --book 只导出指定的书）")
+    mode.add_argument("--pack-import", action="store_true", help="把 output/ 下现有的 txt 打包进归档并删除原文件")
+    ap.add_argument("--book", action="append", help="--export 只导出这本书（可重复）")
+    ap.add_argument("--backend", choices=("txt", "pack"), help=f"输出后端（默认 {OUTPUT_BACKEND}）")
+    ap.add_argument("--epub", action="store_true", help="另外生成 output/书名.epub（边抓边打包）")
+    ap.add_argument("--dedup", choices=("off", "book", "library"),
+                    help=f"章节去重范围（默认 {DEDUP}；打开后跳过重复章节，输出与 1.0 版不再逐字节一致）")
+    ap.add_argument("--async", dest="use_async", action="store_true", help="--update / --backfill 用异步引擎（需 aiohttp）")
+    ap.add_argument("--workers", help="并发范围，如 2-32 自动调整；单个数字为固定并发")
+    ap.add_argument("--pages", type=int, help=f"最多扫描的目录页数（默认 {MAX_PAGES}）")
+    ap.add_argument("--rate", type=float, help=f"每个主机每秒请求数（默认 {RATE}）")
+    ap.add_argument("--interval", type=float, help=f"监视模式的轮询间隔秒数（默认 {WATCH_INTERVAL:g}）")
+    ap.add_argument("--watch-pages", type=int, help=f"监视模式每次检查的目录页数（默认 {WATCH_PAGES}）")
+    return ap.parse_args(argv)
+
+
+def main(argv=None):
+    """命令行入口：无人值守运行（cron、systemd 等），不带模式参数时进入交互菜单"""
+    global MAX_PAGES, RATE, OUTPUT_BACKEND, EPUB_OUTPUT, DEDUP
+    args = parse_args(argv)
+    if args.backend:
+        OUTPUT_BACKEND = args.backend
+    if args.epub:
+        EPUB_OUTPUT = True
+    if args.dedup:
+        DEDUP = args.dedup
+    if args.workers:
+        try:
+            set_concurrency(args.workers)
+        except ValueError:
+            sys.exit(f"--workers 格式不对：{args.workers}（如 2-32 或 8）")
+    # 0 与负数不是「不指定」：明确报错，而不是悄悄沿用默认值
+    if args.pages is not None and args.pages < 1:
+        sys.exit(f"--pages 必须至少为 1：{args.pages}")
+    if args.rate is not None and args.rate <= 0:
+        sys.exit(f"--rate 必须大于 0：{args.rate:g}")
+    if args.interval is not None and args.interval <= 0:
+        sys.exit(f"--interval 必须大于 0：{args.interval:g}")
+    if args.watch_pages is not None and args.watch_pages < 1:
+        sys.exit(f"--watch-pages 必须至少为 1：{args.watch_pages}")
+    if args.pages is not None:
+        MAX_PAGES = args.pages
+    if args.rate is not None:
+        RATE = args.rate
+    apply_settings()
+
+    if args.update and args.use_async:
+        run_async_update()
+    elif args.update:
+        update_novels_threaded()
+    elif args.backfill and args.use_async:
+        run_async_backfill()
+    elif args.backfill:
+        backfill_novels_threaded()
+    elif args.watch:
+        watch_novels(args.interval, args.watch_pages)
+    elif args.cluster:
+        run_cluster_node(seed=args.cluster == "seed")
+    elif args.export:
+        export_archive(args.export, args.book)
+    elif args.pack_import:
+        import_txt_files()
+    else:
+        menu()
+
+
 if __name__ == "__main__":
-    menu()
+    main()